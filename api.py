@@ -0,0 +1,268 @@
+import hashlib
+import json
+import math
+from functools import lru_cache
+
+import flask
+
+import data
+from config import API_PAGE_SIZE
+from functions import EMISSIONS
+
+# bump when the format of the responses changes, so clients holding an old ETag get the new format
+API_VERSION = 1
+# the largest page size a client can ask for
+MAX_PAGE_SIZE = 1000
+
+# the tables served by the api: the name of the table in data.py and the columns the rows can be ranked by
+TABLES = {
+    'power-plants': {'data': 'power_plant_state_year', 'rank_columns': [EMISSIONS, 'Facility Count'],
+                     'description': 'Power plant count and emissions of every state and year'},
+    'emissions': {'data': 'emission_sums_by_state', 'rank_columns': [EMISSIONS],
+                  'description': 'Power plant emissions of every state (abbreviation) and year'},
+    'facilities': {'data': 'top_state_facilities_per_year', 'rank_columns': [EMISSIONS],
+                   'description': 'Largest power plant facilities of every state and year'},
+}
+
+
+def parse_list(text):
+    return [item.strip() for item in text.split(',') if item.strip()] if text else []
+
+
+def parse_int(args, name, default=None, minimum=None, maximum=None):
+    """
+    Read an integer query parameter
+
+    Returns:
+    The value, or the default when the parameter is missing
+    Raises a ValueError with a message for the client when it is not an integer or out of range
+    """
+    text = args.get(name)
+    if text in (None, ''):
+        return default
+    try:
+        value = int(text)
+    except ValueError:
+        raise ValueError(f'{name} must be an integer, not {text!r}') from None
+    if (minimum is not None and value < minimum) or (maximum is not None and value > maximum):
+        raise ValueError(f'{name} must be between {minimum} and {maximum}' if maximum is not None else f'{name} must be at least {minimum}')
+    return value
+
+
+def state_aliases():
+    """
+    Find the name and abbreviation of every state
+
+    Returns:
+    A dictionary from every state name and abbreviation, in lower case, to a tuple of the name and the abbreviation
+    """
+    return {alias.lower(): (name, abbreviation) for abbreviation, name in data.emissions_cube['state_names'].items()
+            for alias in (name, abbreviation)}
+
+
+def parse_filters(args):
+    """
+    Read the filters shared by every endpoint from the query parameters
+        years: a comma separated list of years, or start_year and end_year for a range (both optional)
+        states: a comma separated list of state names or abbreviations
+        top or bottom: keep the n rows with the largest or smallest values of each year
+        rank_by: the column top and bottom rank by (default CO2 emissions (non-biogenic))
+
+    The filters are put in a canonical form (sorted, with states as names), so equal queries get equal cache keys
+
+    Returns:
+    A tuple of the years, the states and the ranking (rank_by, 'top' or 'bottom', n), or None for no ranking
+    Raises a ValueError with a message for the client for invalid filters
+    """
+    if args.get('years'):
+        try:
+            years = {int(year) for year in parse_list(args['years'])}
+        except ValueError:
+            raise ValueError('years must be a comma separated list of years') from None
+    else:
+        start_year = parse_int(args, 'start_year', default=min(data.years))
+        end_year = parse_int(args, 'end_year', default=max(data.years))
+        # pick the loaded years inside the range, so the work does not depend on how wide the range is
+        years = {year for year in data.years if start_year <= year <= end_year}
+    years = tuple(sorted(years & set(data.years)))
+
+    aliases = state_aliases()
+    states = parse_list(args.get('states'))
+    unknown = [state for state in states if state.lower() not in aliases]
+    if unknown:
+        raise ValueError(f'unknown states: {unknown}')
+    states = tuple(sorted({aliases[state.lower()][0] for state in states}))
+
+    if args.get('top') and args.get('bottom'):
+        raise ValueError('use either top or bottom, not both')
+    ranking = None
+    for direction in ('top', 'bottom'):
+        n = parse_int(args, direction, minimum=1)
+        if n is not None:
+            ranking = (args.get('rank_by', EMISSIONS), direction, n)
+    return years, states, ranking
+
+
+def check_ranking(tables, ranking):
+    """
+    Check that every table can be ranked by the rank_by column of a ranking from parse_filters
+
+    Raises a ValueError with a message for the client when one cannot
+    """
+    for table in tables:
+        if ranking is not None and ranking[0] not in TABLES[table]['rank_columns']:
+            raise ValueError(f"rank_by must be one of {TABLES[table]['rank_columns']} for {table}")
+
+
+def select_rows(table, years, states, ranking):
+    """
+    Filter a table by years and states and keep the top or bottom rows of every year
+
+    Input is the name of a table in TABLES and the filters from parse_filters
+
+    Returns:
+    A dataframe of the selected rows, in the order of the table (ranked within each year when a ranking is given)
+    """
+    rows = getattr(data, TABLES[table]['data'])
+    rows = rows[rows['Year'].isin(years)]
+    if states:
+        # the tables hold states by name or by abbreviation, so match both
+        aliases = state_aliases()
+        rows = rows[rows['State'].astype(object).isin([alias for state in states for alias in aliases[state.lower()]])]
+    if ranking is not None:
+        rank_by, direction, n = ranking
+        ranked = rows.dropna(subset=[rank_by]).sort_values(rank_by, ascending=direction == 'bottom', kind='mergesort')
+        rows = ranked.groupby('Year', sort=False).head(n).sort_values('Year', kind='mergesort')
+    return rows
+
+
+def rows_to_records(rows):
+    # to_json turns numpy values, categoricals and missing values into plain json in one vectorized pass
+    return json.loads(rows.to_json(orient='records', double_precision=15))
+
+
+@lru_cache(maxsize=256)
+def build_table_response(dataset_version, table, years, states, ranking, page, per_page):
+    """
+    Build the response body of one page of a table
+
+    Input is the dataset version (so a new version of the data is not answered from the cache),
+    the name of a table in TABLES, the filters from parse_filters and the page
+
+    The body is memoized, so repeated queries only touch pandas once
+
+    Returns:
+    The json body as bytes
+    """
+    rows = select_rows(table, years, states, ranking)
+    pages = max(1, math.ceil(len(rows) / per_page))
+    body = {'table': table, 'dataset_version': dataset_version,
+            'total': len(rows), 'page': page, 'per_page': per_page, 'pages': pages,
+            'data': rows_to_records(rows.iloc[(page - 1) * per_page:page * per_page])}
+    return json.dumps(body).encode('utf-8')
+
+
+@lru_cache(maxsize=64)
+def build_bulk_response(dataset_version, tables, years, states, ranking):
+    """
+    Build the response body of several tables and years
+
+    Returns:
+    The json body as bytes, with the rows of every table grouped by year
+    """
+    body = {'dataset_version': dataset_version, 'years': list(years), 'tables': {}}
+    for table in tables:
+        rows = select_rows(table, years, states, ranking)
+        body['tables'][table] = {str(year): rows_to_records(year_rows) for year, year_rows in rows.groupby('Year', sort=True)}
+    return json.dumps(body).encode('utf-8')
+
+
+def api_cache_stats():
+    """
+    Find the hit and miss counts of the response caches, reported at /metrics (see metrics.process_snapshot)
+
+    Returns:
+    A dictionary with the hits, misses and current size of each response cache, like figures.figure_cache_stats
+    """
+    stats = {}
+    for name, response_cache in (('table', build_table_response), ('bulk', build_bulk_response)):
+        info = response_cache.cache_info()
+        stats[name] = {'hits': info.hits, 'misses': info.misses, 'size': info.currsize}
+    return stats
+
+
+def register_api(server):
+    """
+    Add the read-only json api under /api to the flask server behind the dash app
+
+    Endpoints:
+        /api: the tables, years and states available
+        /api/<table>: one page of a table in TABLES, filtered by the query parameters of parse_filters,
+        with page (from 1) and per_page (default CO2_API_PAGE_SIZE, up to MAX_PAGE_SIZE)
+        /api/bulk: several tables (tables, a comma separated list, default all) for several years in one response
+
+    While the data is loading in the background, every endpoint answers 503 with a Retry-After header
+    Every response has an ETag made from the dataset version and the canonical query, so it is known before
+    the response is built; a request with a matching If-None-Match header gets an empty 304 response
+    without touching the data, and the bodies themselves are memoized (see build_table_response)
+    """
+    blueprint = flask.Blueprint('api', __name__, url_prefix='/api')
+
+    def error_response(message, status=400):
+        return flask.Response(json.dumps({'error': message}), status=status, mimetype='application/json')
+
+    @blueprint.before_request
+    def require_data():
+        # while the data loads in the background (see data.start_background_load), ask clients to come back later
+        if not data.ready.is_set():
+            response = error_response('the data is loading', status=503)
+            response.headers['Retry-After'] = '5'
+            return response
+
+    def cached_response(key, build):
+        etag = hashlib.sha256(f'{API_VERSION}|{data.dataset_version}|{key}'.encode('utf-8')).hexdigest()[:32]
+        if etag in flask.request.if_none_match:
+            response = flask.Response(status=304)
+        else:
+            response = flask.Response(build(), mimetype='application/json')
+        response.set_etag(etag)
+        response.cache_control.no_cache = True # clients may keep the response, but check the ETag before using it
+        return response
+
+    @blueprint.route('')
+    def api_index():
+        return cached_response('index', lambda: json.dumps({
+            'dataset_version': data.dataset_version, 'years': data.years,
+            'states': sorted(data.emissions_cube['state_names'].items()),
+            'tables': {table: {'description': settings['description'], 'rank_columns': settings['rank_columns']}
+                       for table, settings in TABLES.items()}}).encode('utf-8'))
+
+    @blueprint.route('/bulk')
+    def api_bulk():
+        try:
+            years, states, ranking = parse_filters(flask.request.args)
+            tables = tuple(parse_list(flask.request.args.get('tables')) or TABLES)
+            unknown = [table for table in tables if table not in TABLES]
+            if unknown:
+                return error_response(f'unknown tables: {unknown}', status=404)
+            check_ranking(tables, ranking)
+        except ValueError as error:
+            return error_response(str(error))
+        return cached_response(('bulk', tables, years, states, ranking),
+                               lambda: build_bulk_response(data.dataset_version, tables, years, states, ranking))
+
+    @blueprint.route('/<table>')
+    def api_table(table):
+        if table not in TABLES:
+            return error_response(f'unknown table {table!r}, expected one of {list(TABLES)}', status=404)
+        try:
+            years, states, ranking = parse_filters(flask.request.args)
+            page = parse_int(flask.request.args, 'page', default=1, minimum=1)
+            per_page = parse_int(flask.request.args, 'per_page', default=API_PAGE_SIZE, minimum=1, maximum=MAX_PAGE_SIZE)
+            check_ranking([table], ranking)
+        except ValueError as error:
+            return error_response(str(error))
+        return cached_response((table, years, states, ranking, page, per_page),
+                               lambda: build_table_response(data.dataset_version, table, years, states, ranking, page, per_page))
+
+    server.register_blueprint(blueprint)
@@ -0,0 +1,92 @@
+/*
+Clientside versions of the update_graph and update_state_map callbacks in main.py
+
+Used when the dashboard runs with CO2_CLIENTSIDE=1
+The year-data store holds the per-year arrays built by figures.build_year_switching_data,
+so switching years or top/bottom states only redraws the figures in the browser
+*/
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    clientside: {
+        update_graph: function(selectedGraph, selectedYear, selectedResults, initialValues, yearData) {
+            selectedGraph = selectedGraph || initialValues.graph_type;
+            selectedYear = selectedYear || initialValues.year;
+            selectedResults = selectedResults || initialValues.results;
+            var chart = yearData.bar_charts[selectedGraph];
+            var states = yearData.states[String(parseInt(selectedYear))];
+            if (!chart || !states || (selectedResults !== 'Top States' && selectedResults !== 'Bottom States')) {
+                return {};
+            }
+            var values = states[chart.column];
+            var rows = values.map(function(value, row) { return row; });
+            // take the 25 largest or smallest states (sort is stable, so ties keep their order)
+            if (selectedResults === 'Top States') {
+                rows.sort(function(a, b) { return values[b] - values[a]; });
+            } else {
+                rows.sort(function(a, b) { return values[a] - values[b]; });
+            }
+            rows = rows.slice(0, 25).sort(function(a, b) { return values[b] - values[a]; });
+            return {
+                'data': [{'x': rows.map(function(row) { return states['State'][row]; }),
+                          'y': rows.map(function(row) { return values[row]; }),
+                          'type': 'bar', 'name': selectedGraph,
+                          'marker': {'color': chart.color, 'line': {'color': chart.line_color, 'width': 1.5, 'opacity': 0.8}}}],
+                'layout': {'title': chart.title.replace('{year}', selectedYear),
+                           'xaxis': {'title': ''},
+                           'yaxis': {'title': chart.yaxis},
+                           'plot_bgcolor': '#EDEEEE'}
+            };
+        },
+
+        update_state_map: function(selectedDropdownState, selectedSliderYear, currentState, currentYear, yearData) {
+            var selectedState = selectedDropdownState === null ? currentState : selectedDropdownState;
+            var selectedYear = selectedSliderYear === null ? currentYear : selectedSliderYear;
+            var layout = JSON.parse(JSON.stringify(yearData.map_layout));
+            var facilities = yearData.facilities[String(selectedYear)];
+            if (!facilities) {
+                return {'data': [], 'layout': layout};
+            }
+            var rows = [];
+            facilities['State Name'].forEach(function(state, row) {
+                if (state === selectedState) { rows.push(row); }
+            });
+            var column = function(name) { return rows.map(function(row) { return facilities[name][row]; }); };
+            var emissions = column('CO2 emissions (non-biogenic)');
+            var latitudes = column('Latitude');
+            var longitudes = column('Longitude');
+            // size the markers by area like plotly express does (size_max of 20)
+            var sizeref = Math.max.apply(null, emissions.concat([0])) / (20 * 20);
+            var colors = layout.template.layout.colorway;
+            var traces = {};
+            var counties = [];
+            column('County').forEach(function(county, position) {
+                if (!(county in traces)) {
+                    counties.push(county);
+                    traces[county] = {
+                        'type': 'scattergeo', 'mode': 'markers', 'geo': 'geo', 'name': county, 'legendgroup': county,
+                        'showlegend': true, 'lat': [], 'lon': [], 'hovertext': [], 'customdata': [],
+                        'marker': {'color': colors[(counties.length - 1) % colors.length], 'size': [],
+                                   'sizemode': 'area', 'sizeref': sizeref, 'symbol': 'circle'},
+                        'hovertemplate': '<b>%{hovertext}</b><br><br>County=' + county +
+                            '<br>CO2 emissions (non-biogenic)=%{customdata[5]}<br>Latitude=%{lat}<br>Longitude=%{lon}' +
+                            '<br>Address=%{customdata[0]}<br>City=%{customdata[1]}<br>State=%{customdata[2]}' +
+                            '<br>Zip Code=%{customdata[3]}<br>Power Plant Type=%{customdata[4]}<extra></extra>'
+                    };
+                }
+                var row = rows[position];
+                var trace = traces[county];
+                trace.lat.push(latitudes[position]);
+                trace.lon.push(longitudes[position]);
+                trace.hovertext.push(facilities['Facility Name'][row]);
+                trace.marker.size.push(emissions[position]);
+                trace.customdata.push(['Address', 'City', 'State', 'Zip Code', 'Power Plant Type', 'CO2 emissions (non-biogenic)']
+                    .map(function(name) { return facilities[name][row]; }));
+            });
+            // center the map on the facilities
+            if (rows.length > 0) {
+                var mean = function(values) { return values.reduce(function(a, b) { return a + b; }, 0) / values.length; };
+                layout.geo.center = {'lat': mean(latitudes), 'lon': mean(longitudes)};
+            }
+            return {'data': counties.map(function(county) { return traces[county]; }), 'layout': layout};
+        }
+    }
+});
@@ -0,0 +1,322 @@
+"""
+Benchmarks for the data pipeline and the dashboard callbacks
+
+Run with:
+    python benchmark.py
+    python benchmark.py --repeat 5 --scale 10 --synthetic-years 50 --output results.json
+
+Times every stage in functions.py (per csv file and over all years), the end-to-end startup of the data module
+(cold and warm cache), the dash callbacks for representative inputs, the spatial queries of spatial.py
+and synthetic scale-ups of the datasets, along with the peak memory of each step
+The results are saved as json so runs can be compared over time
+"""
+import argparse
+import datetime
+import glob
+import json
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import cube
+import functions
+import trends
+from config import DATASETS_DIR
+
+# the inputs used to time the callbacks
+STATE_MAP_INPUTS = [('Texas', 2020), ('California', 2011), ('Rhode Island', 2015)]
+GRAPH_INPUTS = [('Non-Biogenic CO2 Emissions', 2011, 'Top States'), ('Facility Count', 2020, 'Bottom States')]
+# the spatial queries that are timed: a box around Texas, 100 km around Houston and the 10 facilities nearest Denver
+SPATIAL_QUERIES = [('query_bbox Texas', 'query_bbox', (25.8, -106.6, 36.5, -93.5)),
+                   ('query_radius 100 km Houston', 'query_radius', (29.76, -95.37, 100)),
+                   ('query_nearest 10 Denver', 'query_nearest', (39.74, -104.99, 10))]
+
+
+def measure(function, *args, repeat=3, **kwargs):
+    """
+    Time a function and find the peak memory it allocates
+
+    The function is run repeat times; the fastest run is reported
+    Peak memory is measured with tracemalloc during one extra run, so it does not slow down the timed runs
+
+    Returns:
+    A tuple of the result of the function, the fastest time in seconds and the peak memory in MB
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        timings.append(time.perf_counter() - start)
+    tracemalloc.start()
+    function(*args, **kwargs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, min(timings), peak / 2**20
+
+
+def record(results, group, name, seconds, peak_mb=None, **details):
+    """
+    Add a measurement to the results and print it
+    """
+    results.append({'group': group, 'name': name, 'seconds': seconds, 'peak_mb': peak_mb, **details})
+    memory = '' if peak_mb is None else f'  peak {peak_mb:8.1f} MB'
+    print(f'{group:<10} {name:<55} {seconds * 1000:10.1f} ms{memory}')
+
+
+def year_of(file):
+    return int(re.search(r'(\d{4})\.csv$', file).group(1))
+
+
+def benchmark_stages(results, files, repeat, group='stages'):
+    """
+    Time each stage of the pipeline in functions.py
+
+    Reading and cleaning are timed for every csv file, then the cleaned years are stacked into one tall dataframe
+    and the filling and aggregation stages are timed once over all of the years,
+    along with building the aggregation cube and slicing the power plant tables out of it,
+    and building the facility by year matrix and ranking the largest changes in emissions from it
+    """
+    frames = []
+    years = []
+    for file in files:
+        data, seconds, peak = measure(functions.import_and_clean, file, repeat=repeat)
+        record(results, group, f'import_and_clean {os.path.basename(file)}', seconds, peak, rows=len(data))
+        frames.append(data)
+        years.append(year_of(file))
+    data, seconds, peak = measure(functions.stack_years, frames, years, repeat=repeat)
+    record(results, group, 'stack_years (with classify_facilities)', seconds, peak, rows=len(data))
+    data, seconds, peak = measure(lambda: functions.fill_na_values(data.copy(), by=('Year', 'State', 'Industry Type (sectors)')),
+                                  repeat=repeat)
+    record(results, group, 'fill_na_values', seconds, peak, rows=len(data))
+    _, seconds, peak = measure(functions.state_facility_data, data, repeat=repeat)
+    record(results, group, 'state_facility_data', seconds, peak, rows=len(data))
+    locations, seconds, peak = measure(functions.facility_locations, data, repeat=repeat)
+    record(results, group, 'facility_locations', seconds, peak, rows=len(data))
+    cells, seconds, peak = measure(cube.cube_cells, locations, repeat=repeat)
+    record(results, group, 'cube_cells', seconds, peak, rows=len(locations))
+    emissions_cube, seconds, peak = measure(cube.build_cube, cells, repeat=repeat)
+    record(results, group, 'build_cube', seconds, peak, rows=len(cells))
+    power_plant_state_year, seconds, peak = measure(functions.power_plants_data, emissions_cube, repeat=repeat)
+    record(results, group, 'power_plants_data (cube slice)', seconds, peak, rows=len(power_plant_state_year))
+    emission_sums, seconds, peak = measure(functions.power_plant_emissions_per_state_year, emissions_cube, repeat=repeat)
+    record(results, group, 'power_plant_emissions_per_state_year (cube slice)', seconds, peak, rows=len(emission_sums))
+    _, seconds, peak = measure(functions.top_5_states, power_plant_state_year, repeat=repeat)
+    record(results, group, 'top_5_states', seconds, peak, rows=len(power_plant_state_year))
+    facility_matrix, seconds, peak = measure(trends.build_facility_matrix, locations, repeat=repeat)
+    record(results, group, 'build_facility_matrix', seconds, peak, rows=len(locations))
+    changes, seconds, peak = measure(trends.emission_changes, facility_matrix, years[0], years[-1], repeat=repeat)
+    record(results, group, 'emission_changes (facility matrix)', seconds, peak, rows=len(facility_matrix['facilities']))
+
+
+def benchmark_startup(results, repeat):
+    """
+    Time the end-to-end startup of the data module in a fresh python process
+
+    Measures a bare 'import data' and loading every table used by the dashboard,
+    first with an empty cache directory and then with the cache filled in,
+    and importing the app with CO2_BACKGROUND_LOAD=1, which is how long the web server takes to be able to start
+    """
+    load_tables = ('import data; data.power_plant_state_year; data.top_state_facilities_per_year; '
+                   'data.emission_sums_by_state; data.emissions_change; data.top_emitting_states')
+    # report the peak resident memory of the child process in MB (not available on windows)
+    # on linux ru_maxrss keeps the peak of the benchmark process it was forked from, so the child reads
+    # its own peak (VmHWM) from /proc instead; ru_maxrss is in KB on linux and in bytes on macos
+    report_memory = (
+        "\nimport resource, sys"
+        "\ntry:"
+        "\n    with open('/proc/self/status') as status:"
+        "\n        print(int(next(line for line in status if line.startswith('VmHWM:')).split()[1]) / 2**10)"
+        "\nexcept OSError:"
+        "\n    print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2**20 if sys.platform == 'darwin' else 2**10))")
+    if sys.platform == 'win32':
+        report_memory = ''
+    cache_dir = tempfile.mkdtemp(prefix='co2-benchmark-cache-')
+    try:
+        environment = dict(os.environ, CO2_CACHE_DIR=cache_dir)
+        for name, code in [('import data', 'import data'),
+                           ('load all tables, cold cache', load_tables),
+                           ('load all tables, warm cache', load_tables),
+                           ('import main, background load', "import os; os.environ['CO2_BACKGROUND_LOAD'] = '1'; import main")]:
+            timings = []
+            peak = None
+            for attempt in range(1 if 'cold' in name else repeat):
+                start = time.perf_counter()
+                output = subprocess.run([sys.executable, '-c', code + report_memory], env=environment,
+                                        cwd=os.path.dirname(os.path.abspath(__file__)),
+                                        check=True, capture_output=True, text=True).stdout
+                timings.append(time.perf_counter() - start)
+                if report_memory:
+                    peak = float(output.split()[-1])
+            record(results, 'startup', name, min(timings), peak)
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+def benchmark_callbacks(results, repeat):
+    """
+    Time the dash callbacks in main.py for representative inputs
+
+    Each callback is timed on its first call (empty figure caches) and on repeated calls
+    """
+    import data
+    import figures
+    import main
+    # load the tables first, so the timings only cover the callbacks
+    data.state_year_index, data.power_plant_state_year, data.emission_sums_by_state
+    for state, year in STATE_MAP_INPUTS:
+        _, seconds, peak = measure(main.update_state_map, state, year, None, None, repeat=repeat)
+        record(results, 'callbacks', f'update_state_map {state} {year}', seconds, peak)
+    for graph, year, results_type in GRAPH_INPUTS:
+        figures.bar_chart_figure.cache_clear()
+        start = time.perf_counter()
+        main.update_graph(graph, year, results_type, {})
+        record(results, 'callbacks', f'update_graph {graph} {year} {results_type}, first call', time.perf_counter() - start)
+        _, seconds, peak = measure(main.update_graph, graph, year, results_type, {}, repeat=repeat)
+        record(results, 'callbacks', f'update_graph {graph} {year} {results_type}, cached', seconds, peak)
+    figures.build_choropleth_figure.cache_clear()
+    start = time.perf_counter()
+    main.update_choropleth_map(None)
+    record(results, 'callbacks', 'update_choropleth_map, first call', time.perf_counter() - start)
+    _, seconds, peak = measure(main.update_choropleth_map, None, repeat=repeat)
+    record(results, 'callbacks', 'update_choropleth_map, cached', seconds, peak)
+
+
+def benchmark_spatial(results, repeat, scale):
+    """
+    Time the spatial index of every facility and year (data.spatial_index), its queries
+    and the clusters of the power plants at every zoom level (data.facility_clusters)
+
+    Each query is timed over every year and for the latest year
+    With scale above 1, the facilities are also repeated scale times (moved by up to a few km each time)
+    to time the index and queries on a larger set of facilities
+    """
+    import data
+    import spatial
+    from config import SPATIAL_CELL_DEGREES, CLUSTER_ZOOM_LEVELS
+    locations = data.facility_locations
+    for label, facilities in [('spatial', locations), (f'{scale}x spatial', None)]:
+        if facilities is None:
+            if scale <= 1:
+                break
+            random = np.random.default_rng(0)
+            facilities = pd.concat([locations] * scale, ignore_index=True)
+            facilities['Latitude'] += random.uniform(-0.05, 0.05, len(facilities))
+            facilities['Longitude'] += random.uniform(-0.05, 0.05, len(facilities))
+        index, seconds, peak = measure(spatial.build_spatial_index, facilities, SPATIAL_CELL_DEGREES, repeat=repeat)
+        record(results, label, 'build_spatial_index', seconds, peak, rows=len(facilities))
+        power_plants = facilities[facilities['Power Plant']]
+        _, seconds, peak = measure(spatial.build_cluster_levels, power_plants, CLUSTER_ZOOM_LEVELS, repeat=repeat)
+        record(results, label, f'build_cluster_levels, {CLUSTER_ZOOM_LEVELS} levels', seconds, peak, rows=len(power_plants))
+        for name, query, arguments in SPATIAL_QUERIES:
+            for year in (None, data.latest_year):
+                found, seconds, peak = measure(getattr(spatial, query), index, *arguments, year=year, repeat=repeat)
+                record(results, label, f"{name}, {year or 'all years'}", seconds, peak, rows=len(found))
+
+
+def write_scaled_file(file, directory, scale, year=None):
+    """
+    Write a copy of a csv file with its data rows repeated scale times
+
+    The three lines of notes and the header line are kept once
+    If a year is given, the copy is named after that year instead of the year of the original file
+
+    Returns:
+    The path of the new file
+    """
+    with open(file, encoding='utf-8') as source:
+        lines = source.readlines()
+    header, rows = lines[:functions.HEADER_ROW + 1], lines[functions.HEADER_ROW + 1:]
+    path = os.path.join(directory, f'direct_emitters{year or year_of(file)}.csv')
+    with open(path, 'w', encoding='utf-8') as output:
+        output.writelines(header)
+        for _ in range(scale):
+            output.writelines(rows)
+    return path
+
+
+def benchmark_synthetic(results, files, repeat, scale, synthetic_years):
+    """
+    Time the pipeline on synthetic scale-ups of the bundled datasets
+
+    The latest csv file is repeated scale times to time the stages (and streaming it in chunks) on larger files,
+    and the bundled years are copied under new years to time loading synthetic_years years of data
+    """
+    import cache
+    from ingest import process_years
+    from streaming import stream_year
+    directory = tempfile.mkdtemp(prefix='co2-benchmark-data-')
+    try:
+        if scale > 1:
+            scaled_file = write_scaled_file(files[-1], directory, scale)
+            benchmark_stages(results, [scaled_file], repeat, group=f'{scale}x rows')
+            for chunk_rows in (10000, 50000):
+                _, seconds, peak = measure(stream_year, scaled_file, year_of(scaled_file), chunk_rows, repeat=repeat)
+                record(results, f'{scale}x rows', f'stream_year, {chunk_rows} row chunks', seconds, peak)
+            os.remove(scaled_file)
+        if synthetic_years:
+            years = list(range(2020 - synthetic_years + 1, 2021))
+            synthetic_files = [write_scaled_file(files[position % len(files)], directory, 1, year)
+                               for position, year in enumerate(years)]
+            default_cache_dir = cache.CACHE_DIR
+            for workers in sorted({1, os.cpu_count() or 1}):
+                # use an empty cache directory, so every year is cleaned and the real cache is left alone
+                cache.CACHE_DIR = os.path.join(directory, f'cache-{workers}')
+                start = time.perf_counter()
+                process_years(synthetic_files, years, workers=workers)
+                record(results, f'{synthetic_years} years', f'process_years, {workers} worker(s)', time.perf_counter() - start,
+                       files=len(synthetic_files))
+            cache.CACHE_DIR = default_cache_dir
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the CO2 emissions data pipeline and dashboard callbacks')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed runs per measurement (the fastest is kept)')
+    parser.add_argument('--scale', type=int, default=10, help='repeat the rows of the latest file this many times (1 to skip)')
+    parser.add_argument('--synthetic-years', type=int, default=50, help='number of years for the multi-year scale-up (0 to skip)')
+    parser.add_argument('--skip', nargs='*', default=[], choices=['stages', 'startup', 'callbacks', 'spatial', 'synthetic'],
+                        help='parts of the benchmark to skip')
+    parser.add_argument('--output', default=None, help='json file for the results (default: benchmark_results/<timestamp>.json)')
+    args = parser.parse_args()
+
+    files = sorted(glob.glob(os.path.join(glob.escape(DATASETS_DIR), 'direct_emitters*.csv')))
+    results = []
+    if 'stages' not in args.skip:
+        benchmark_stages(results, files, args.repeat)
+    if 'startup' not in args.skip:
+        benchmark_startup(results, args.repeat)
+    if 'callbacks' not in args.skip:
+        benchmark_callbacks(results, args.repeat)
+    if 'spatial' not in args.skip:
+        benchmark_spatial(results, args.repeat, args.scale)
+    if 'synthetic' not in args.skip:
+        benchmark_synthetic(results, files, args.repeat, args.scale, args.synthetic_years)
+
+    timestamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+    output = args.output or os.path.join('benchmark_results', f'{timestamp}.json')
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as results_file:
+        json.dump({'timestamp': timestamp,
+                   'python': platform.python_version(),
+                   'pandas': pd.__version__,
+                   'numpy': np.__version__,
+                   'platform': platform.platform(),
+                   'cpu_count': os.cpu_count(),
+                   'repeat': args.repeat,
+                   'results': results}, results_file, indent=2)
+    print(f'Results saved to {output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,25 +1,31 @@
 import dash_bootstrap_components as dbc
 from dash import html, dcc
 import plotly.express as px
-from data import emission_sums_by_state, states, total_emissions_per_year
+from config import CLIENTSIDE_CALLBACKS, TOP_FACILITIES
+import data
+from data import states, years
+from figures import year_switching_data
 
 initial_graph = 'Non-Biogenic CO2 Emissions'
-initial_map_year = 2011
-initial_graph_year = 2011
+initial_map_year = years[0]
+initial_graph_year = years[0]
 initial_state = 'Texas'
 initial_results = 'Top States'
-
-initial_choropleth = px.choropleth(emission_sums_by_state,
-                            locations='State',
-                            locationmode='USA-states',
-                            color='CO2 emissions (non-biogenic)',
-                            color_continuous_scale='deep',
-                            range_color=[emission_sums_by_state['CO2 emissions (non-biogenic)'].min(),
-                                         emission_sums_by_state['CO2 emissions (non-biogenic)'].max()],
-                            scope='usa')
+initial_change_direction = 'Decliners'
 
 
 def create_body():
+    emission_sums_by_state = data.emission_sums_by_state
+    total_emissions_per_year = data.total_emissions_per_year
+    initial_choropleth = px.choropleth(emission_sums_by_state,
+                                locations='State',
+                                locationmode='USA-states',
+                                color='CO2 emissions (non-biogenic)',
+                                color_continuous_scale='deep',
+                                range_color=[emission_sums_by_state['CO2 emissions (non-biogenic)'].min(),
+                                             emission_sums_by_state['CO2 emissions (non-biogenic)'].max()],
+                                scope='usa')
+
     body_content = dbc.Container(
         children=[
             html.Br(),
@@ -62,13 +68,11 @@ def create_body():
                             ),
                             dcc.Slider(
                                 id='year-slider',
-                                min=2011,
-                                max=2020,
-                                step=1,
+                                min=years[0],
+                                max=years[-1],
+                                step=None, # only the years with a dataset, which need not be consecutive
                                 value=initial_graph_year,
-                                marks={2011: '2011', 2012: '2012', 2013: '2013', 2014: '2014',
-                                       2015: '2015', 2016: '2016', 2017: '2017', 2018: '2018',
-                                       2019: '2019', 2020: '2020'},
+                                marks={year: str(year) for year in years},
                             ),
                             dcc.Graph(
                                 id = 'data-graph',
@@ -78,6 +82,10 @@ def create_body():
                                         'year': initial_graph_year,
                                         'results': initial_results}
                                     ),
+                            # per-year arrays for switching years in the browser (see assets/clientside.js)
+                            dcc.Store(id='year-data',
+                                    data=year_switching_data() if CLIENTSIDE_CALLBACKS else None
+                                    ),
                         ],
                     ),
                     dbc.Container(
@@ -124,7 +132,7 @@ def create_body():
                             dbc.Container(
                                 className="graph-container graph3",
                                 children=[
-                                    html.H2(children='Thirty Largest Facilities By State',
+                                    html.H2(children=f'{TOP_FACILITIES} Largest Facilities By State',
                                             style={'font-family': 'Garamond', 'font-size': '20px', 'color': 'rgb(3, 44, 97)'}),
                                     dcc.Dropdown(
                                         id='state-selection',
@@ -143,13 +151,21 @@ def create_body():
                                     ),
                                     dcc.Slider(
                                         id='map-year-slider',
-                                        min=2011,
-                                        max=2020,
-                                        step=1,
+                                        min=years[0],
+                                        max=years[-1],
+                                        step=None, # only the years with a dataset, which need not be consecutive
                                         value=initial_map_year,
-                                        marks={2011: '2011', 2012: '2012', 2013: '2013', 2014: '2014',
-                                               2015: '2015', 2016: '2016', 2017: '2017', 2018: '2018',
-                                               2019: '2019', 2020: '2020'}
+                                        marks={year: str(year) for year in years}
+                                    ),
+                                    dcc.RadioItems(
+                                        id='map-mode',
+                                        options=[
+                                            {'label': ' Largest facilities of the state', 'value': 'state'},
+                                            {'label': ' Power plants in view (pan and zoom)', 'value': 'viewport'},
+                                        ],
+                                        value='state',
+                                        inline=True,
+                                        labelStyle={'margin-right': '20px'}
                                     ),
                                     dcc.Graph(
                                         id='map',
@@ -158,6 +174,16 @@ def create_body():
                                             'display':'inline-block'
                                         }
                                     ),
+                                    # the map of the 'power plants in view' mode, redrawn from the spatial index as it is panned and zoomed
+                                    dcc.Graph(
+                                        id='viewport-map',
+                                        style={
+                                            'width': '100%',
+                                            'height': '450px',
+                                            'display': 'none'
+                                        }
+                                    ),
+                                    dcc.Store(id='viewport-bounds'),
                                 ]
                             ),
                             dbc.Container(
@@ -188,6 +214,91 @@ def create_body():
                         ])
                     )
                 ]  
+            ),
+
+            html.Br(),
+
+            dbc.Row([
+                dbc.Col(
+                    dbc.Container(
+                        className='parent',
+                        children=[
+                            dbc.Container(
+                                className='graph-container graph5',
+                                children=[
+                                    html.H2(children='Largest Changes in Power Plant Emissions',
+                                            style={'font-family': 'Garamond', 'font-size': '20px', 'color': 'rgb(3, 44, 97)'}),
+                                    dcc.RadioItems(
+                                        id='change-direction',
+                                        options=[
+                                            {'label': ' Largest decreases', 'value': 'Decliners'},
+                                            {'label': ' Largest increases', 'value': 'Increasers'},
+                                        ],
+                                        value=initial_change_direction,
+                                        inline=True,
+                                        labelStyle={'margin-right': '20px'}
+                                    ),
+                                    dcc.Dropdown(
+                                        id='change-state',
+                                        placeholder='All States',
+                                        style={
+                                            'width': '80%',
+                                            'display': 'inline-block',
+                                            'margin-bottom': '10px',
+                                            'text-align': 'center',
+                                        },
+                                        options=[{'label': state, 'value': state} for state in states],
+                                    ),
+                                    dcc.RangeSlider(
+                                        id='change-years',
+                                        min=years[0],
+                                        max=years[-1],
+                                        step=None, # only the years with a dataset, which need not be consecutive
+                                        value=[years[0], years[-1]],
+                                        marks={year: str(year) for year in years},
+                                        pushable=1 # the two years are always at least one year apart
+                                    ),
+                                    # the facility id of every bar is in its customdata; clicking a bar shows its trend
+                                    dcc.Graph(
+                                        id='facility-changes',
+                                    ),
+                                ]
+                            ),
+                            dbc.Container(
+                                className='graph-container graph6',
+                                children=[
+                                    html.H2(children='Emissions of a Facility Over the Years',
+                                            style={'font-family': 'Garamond', 'font-size': '20px', 'color': 'rgb(3, 44, 97)'}),
+                                    dcc.Graph(
+                                        id='facility-trend',
+                                    ),
+                                ]
+                            )
+                        ])
+                    )
+                ]
             )
         ])
     return body_content
+
+
+def create_loading_body():
+    """
+    Build the placeholder shown in place of the graphs while the data is loading (see data.start_background_load)
+
+    The interval checks every second whether the data is ready and then reloads the page, which gets the full layout
+
+    Returns:
+    The placeholder container
+    """
+    return dbc.Container(
+        children=[
+            html.Br(),
+            dbc.Spinner(color='primary'),
+            html.H2(children='Loading the emissions data...',
+                    style={'font-family': 'Garamond', 'font-size': '20px', 'color': 'rgb(3, 44, 97)', 'text-align': 'center'}),
+            dcc.Interval(id='loading-interval', interval=1000),
+            dcc.Location(id='loading-location', refresh=True),
+        ],
+        style={'text-align': 'center'}
+    )
@@ -0,0 +1,231 @@
+import glob
+import hashlib
+import inspect
+import json
+import os
+from contextlib import contextmanager, suppress
+
+import numpy as np
+import pandas as pd
+
+from config import CACHE_DIR, USE_CACHE, TOP_FACILITIES, STREAM_CHUNK_ROWS
+from metrics import timed_stage
+from functions import (COLUMN_TYPES, HEADER_ROW, EMISSIONS, LOCATION_COLUMNS, POWER_PLANT_TYPES, CATEGORY_COLUMNS,
+                       INTEGER_TYPES, read_header, read_arguments, read_data, import_and_clean,
+                       normalize_text, clean_data, stack_years, aggregate_years, fill_na_values, classify_facilities,
+                       state_facility_data, top_k_per_group, facility_locations, compact_frame)
+from cube import DIMENSIONS, MEASURES, CELL_COLUMNS, cube_cells, combine_cells
+from streaming import FILL_GROUPS, add_totals, keep_top_rows, stream_year
+
+# the functions whose output is stored in the cache; changing any of them invalidates every cached year
+CLEANING_STEPS = [read_header, read_arguments, read_data, import_and_clean, normalize_text, clean_data]
+# the module constants the cleaning steps read, which invalidate the cache in the same way
+CLEANING_CONSTANTS = [COLUMN_TYPES, HEADER_ROW]
+# the functions that compute the yearly aggregates recorded in the manifest
+AGGREGATION_STEPS = [stack_years, aggregate_years, fill_na_values, classify_facilities, state_facility_data,
+                     top_k_per_group, facility_locations, cube_cells, compact_frame]
+# the settings and module constants that shape the yearly aggregates: the facilities kept, the power plant types,
+# the compact column types and the dimensions and measures of the cube cells
+AGGREGATION_CONSTANTS = [TOP_FACILITIES, EMISSIONS, LOCATION_COLUMNS, POWER_PLANT_TYPES, CATEGORY_COLUMNS, INTEGER_TYPES,
+                         DIMENSIONS, MEASURES, CELL_COLUMNS]
+# the functions and constants that compute the yearly aggregates when the csv files are streamed
+STREAMING_STEPS = [add_totals, keep_top_rows, combine_cells, stream_year]
+STREAMING_CONSTANTS = [FILL_GROUPS]
+
+# the file in CACHE_DIR that lists the processed years
+MANIFEST_FILE = 'manifest.json'
+# the file in CACHE_DIR that is locked while the manifest is rewritten and stale tables are removed
+LOCK_FILE = 'manifest.lock'
+
+
+def cleaning_version():
+    """
+    Find the version of the cleaning code
+
+    Hashes the source code of every function in CLEANING_STEPS along with CLEANING_CONSTANTS (the columns that are read
+    and the position of the header row)
+
+    Returns:
+    A hex digest that changes whenever the cleaning code changes
+    """
+    digest = hashlib.sha256(repr(CLEANING_CONSTANTS).encode('utf-8'))
+    for step in CLEANING_STEPS:
+        digest.update(inspect.getsource(step).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def aggregation_version():
+    """
+    Find the version of the aggregation code
+
+    Hashes the source code of every function in AGGREGATION_STEPS along with AGGREGATION_CONSTANTS
+    (and STREAMING_STEPS and STREAMING_CONSTANTS when streaming), so editing any of them recomputes every year
+
+    Returns:
+    A hex digest that changes whenever the yearly aggregates would change
+    """
+    constants = AGGREGATION_CONSTANTS + (STREAMING_CONSTANTS if STREAM_CHUNK_ROWS else [])
+    digest = hashlib.sha256(repr(constants).encode('utf-8'))
+    for step in AGGREGATION_STEPS + (STREAMING_STEPS if STREAM_CHUNK_ROWS else []):
+        digest.update(inspect.getsource(step).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def file_checksum(file):
+    """
+    Find the sha256 checksum of a file, reading it in 1 MB blocks
+
+    Returns:
+    The hex digest of the file contents
+    """
+    digest = hashlib.sha256()
+    with open(file, 'rb') as source:
+        for block in iter(lambda: source.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def cache_key(file):
+    """
+    Find the cache key of a csv file
+
+    The key combines the checksum of the file with the version of the cleaning code,
+    so either a changed csv or changed cleaning code leads to a new key
+
+    Returns:
+    A 16 character hex string
+    """
+    return hashlib.sha256((file_checksum(file) + cleaning_version()).encode('utf-8')).hexdigest()[:16]
+
+
+def save_frame(data, path):
+    """
+    Save a dataframe to a columnar NumPy .npz archive
+
+    Each column is stored as its own array
+    String columns are dictionary encoded into integer codes and an array of the unique values,
+    so the archive stays small and can be loaded back without pickling (null values get code -1)
+    Categorical columns keep their own codes and categories
+    The file is written under a temporary name first and then renamed, so readers never see a partial file
+    """
+    arrays = {'__columns__': np.array(data.columns, dtype=str),
+              '__index__': data.index.to_numpy()}
+    for position, column in enumerate(data.columns):
+        values = data[column].to_numpy()
+        if data[column].dtype == 'category':
+            # store the codes and categories as they are, so the column is loaded back as a categorical
+            values = data[column].cat.codes.to_numpy()
+            arrays[f'categories{position}'] = np.array(data[column].cat.categories, dtype=str)
+        elif values.dtype == object:
+            values, uniques = pd.factorize(values)
+            arrays[f'uniques{position}'] = np.array(uniques, dtype=str)
+        arrays[f'column{position}'] = values
+    temporary_path = f'{path}.{os.getpid()}.tmp'
+    with open(temporary_path, 'wb') as output:
+        np.savez(output, **arrays)
+    os.replace(temporary_path, path)
+
+
+def load_frame(path):
+    """
+    Load a dataframe saved with save_frame
+
+    Returns:
+    The dataframe with its original columns, index, categoricals and null values
+    """
+    with np.load(path, allow_pickle=False) as archive:
+        columns = {}
+        for position, column in enumerate(archive['__columns__']):
+            values = archive[f'column{position}']
+            if f'categories{position}' in archive.files:
+                values = pd.Categorical.from_codes(values, archive[f'categories{position}'].astype(object))
+            elif f'uniques{position}' in archive.files:
+                # append a null value so that code -1 maps to it
+                uniques = np.append(archive[f'uniques{position}'].astype(object), np.nan)
+                values = uniques[values]
+            columns[str(column)] = values
+        return pd.DataFrame(columns, index=archive['__index__'])
+
+
+def load_clean_data(file):
+    """
+    Load the cleaned data for a csv file, using the on-disk cache when possible
+
+    Function looks for a cached frame matching the cache key of the file
+        If it exists, the frame is loaded from the cache
+        Otherwise the csv is run through import_and_clean,
+        the result is saved to the cache and older cache entries for the same file are removed
+    The missing emissions are filled in later, for all years at once (see functions.aggregate_years)
+
+    Returns:
+    A cleaned dataframe, but may contain null values
+    """
+    if not USE_CACHE:
+        return import_and_clean(file)
+    name = os.path.splitext(os.path.basename(file))[0]
+    path = os.path.join(CACHE_DIR, f'{name}-{cache_key(file)}.npz')
+    if os.path.exists(path):
+        with timed_stage('cache_load') as counts:
+            data = load_frame(path)
+            counts['rows'] = len(data)
+        return data
+    data = import_and_clean(file)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    save_frame(data, path)
+    # remove the cache entries of older versions of this file; another process sharing the cache
+    # (a gunicorn worker or export.py) may have removed them first
+    for stale_path in glob.glob(os.path.join(glob.escape(CACHE_DIR), f'{name}-*.npz')):
+        if stale_path != path:
+            with suppress(FileNotFoundError):
+                os.remove(stale_path)
+    return data
+
+
+def load_manifest():
+    """
+    Load the manifest of processed years from the cache directory
+
+    Returns:
+    A dictionary with an entry for every processed year (keyed by the year as a string),
+    or an empty dictionary if there is no manifest or it cannot be read
+    """
+    try:
+        with open(os.path.join(CACHE_DIR, MANIFEST_FILE)) as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(manifest):
+    """
+    Save the manifest of processed years to the cache directory
+
+    Like save_frame, the file is written under a temporary name first and then renamed
+    """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    path = os.path.join(CACHE_DIR, MANIFEST_FILE)
+    temporary_path = f'{path}.{os.getpid()}.tmp'
+    with open(temporary_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    os.replace(temporary_path, path)
+
+
+@contextmanager
+def manifest_lock():
+    """
+    Hold an exclusive lock on the cache directory while the manifest is rewritten
+
+    Several processes can load the data into the same cache directory at once (the gunicorn workers
+    in background loading mode, or export.py next to a running dashboard), so they take turns
+    The lock is an flock on LOCK_FILE, released when the file is closed; on platforms without fcntl
+    (Windows) no lock is taken
+    """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    with open(os.path.join(CACHE_DIR, LOCK_FILE), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
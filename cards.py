@@ -1,47 +1,72 @@
 import dash_bootstrap_components as dbc
 from dash import html
 
-from data import data_2020_power_plants_total, top_emitting_states, total_state_facilities_2020, emissions_change
+import data
 
-card1 = dbc.Card(
-       [
-       html.H4(f"Total U.S. Power Plant Emissions in 2020:",
-               className='card1-text'),
-       html.H6(f"{data_2020_power_plants_total.iloc[0]['Total Power Plant Emissions']:,} metric tons",
-       className='card1-text')
-       ]
-)
+# the text shown in place of the figures on the cards while the data is loading
+LOADING_TEXT = 'Loading...'
 
-card2 = dbc.Card(
-    [
-    html.H4(f"A substantial decrease of ",
-            className='card4-text'),
-    html.H6(f"{emissions_change:,} metric tons",
-            className='card4-text'),
-    html.H6(f"from year 2011 to 2020",
-            className="card4-text")
-    ]
-)
 
-card3 = dbc.Card(
-    [
-    html.H4(f"Top Emitting States:",
-            className='card2-text'),
-    html.H6(f"{top_emitting_states}",
-            className='card2-text')
-    ]
-)
+def create_card_list(loading=False):
+    """
+    Build the four summary cards
 
-card4 = dbc.Card(
-    [
-    html.H4(f"Total Power Plant Facilites Across the U.S. in 2020:",
-            className='card3-text'),
-    html.H6(f"{total_state_facilities_2020}",
-            className='card3-text')
-    ]
-)
+    Input is whether the data is still loading (see data.start_background_load);
+    the cards then keep their titles and show LOADING_TEXT in place of every figure
 
-def create_cards():
+    Returns:
+    A list of the four cards
+    """
+    first_year, latest_year = data.first_year, data.latest_year
+    if loading:
+        total_emissions = emissions_change = top_emitting_states = total_facilities = LOADING_TEXT
+    else:
+        total_emissions = f"{data.latest_year_power_plants_total.iloc[0]['Total Power Plant Emissions']:,} metric tons"
+        emissions_change = f"{data.emissions_change:,} metric tons"
+        top_emitting_states = f"{data.top_emitting_states}"
+        total_facilities = f"{data.total_state_facilities_latest_year}"
+
+    card1 = dbc.Card(
+           [
+           html.H4(f"Total U.S. Power Plant Emissions in {latest_year}:",
+                   className='card1-text'),
+           html.H6(total_emissions,
+           className='card1-text')
+           ]
+    )
+
+    card2 = dbc.Card(
+        [
+        html.H4(f"A substantial decrease of ",
+                className='card4-text'),
+        html.H6(emissions_change,
+                className='card4-text'),
+        html.H6(f"from year {first_year} to {latest_year}",
+                className="card4-text")
+        ]
+    )
+
+    card3 = dbc.Card(
+        [
+        html.H4(f"Top Emitting States:",
+                className='card2-text'),
+        html.H6(top_emitting_states,
+                className='card2-text')
+        ]
+    )
+
+    card4 = dbc.Card(
+        [
+        html.H4(f"Total Power Plant Facilites Across the U.S. in {latest_year}:",
+                className='card3-text'),
+        html.H6(total_facilities,
+                className='card3-text')
+        ]
+    )
+    return [card1, card2, card3, card4]
+
+def create_cards(loading=False):
+    card1, card2, card3, card4 = create_card_list(loading)
     cards = dbc.Container(
         children=[
             html.Br(),
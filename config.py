@@ -0,0 +1,34 @@
+import os
+
+# directory that holds the yearly GHGRP csv files
+DATASETS_DIR = os.environ.get('CO2_DATASETS_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'datasets'))
+# directory that holds the on-disk cache of cleaned yearly frames
+CACHE_DIR = os.environ.get('CO2_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache'))
+# set CO2_USE_CACHE=0 to always rebuild the frames from the csv files
+USE_CACHE = os.environ.get('CO2_USE_CACHE', '1') != '0'
+# number of worker processes used to load the yearly datasets; 1 loads them one after another
+INGEST_WORKERS = int(os.environ.get('CO2_INGEST_WORKERS', os.cpu_count() or 1))
+# number of largest power plant facilities kept per state and year for the facility map
+TOP_FACILITIES = int(os.environ.get('CO2_TOP_FACILITIES', 30))
+# rows per chunk when streaming the csv files (see streaming.py); 0 loads each csv file whole
+STREAM_CHUNK_ROWS = int(os.environ.get('CO2_STREAM_CHUNK_ROWS', 0))
+# size in degrees of the latitude and longitude grid cells of the spatial index of facilities (see spatial.py)
+SPATIAL_CELL_DEGREES = float(os.environ.get('CO2_SPATIAL_CELL_DEGREES', 0.5))
+# largest number of individual power plants drawn on the facility map in the 'power plants in view' mode;
+# with more in view, the precomputed clusters of the zoom level are drawn instead
+VIEWPORT_FACILITIES = int(os.environ.get('CO2_VIEWPORT_FACILITIES', 500))
+# number of zoom levels (0, the whole globe, and up) with precomputed clusters of the power plants;
+# zoomed in further, the VIEWPORT_FACILITIES largest power plants in view are drawn
+CLUSTER_ZOOM_LEVELS = int(os.environ.get('CO2_CLUSTER_ZOOM_LEVELS', 10))
+# set CO2_CLIENTSIDE=1 to switch the years of the bar chart and facility map in the browser instead of on the server
+CLIENTSIDE_CALLBACKS = os.environ.get('CO2_CLIENTSIDE', '0') == '1'
+# number of rows per page of the json api at /api (see api.py), when the client does not ask for a page size
+API_PAGE_SIZE = int(os.environ.get('CO2_API_PAGE_SIZE', 100))
+# set CO2_METRICS=0 to turn off the pipeline and callback metrics served at /metrics
+METRICS_ENABLED = os.environ.get('CO2_METRICS', '1') != '0'
+# set CO2_BACKGROUND_LOAD=1 to start the web server right away and load the data in a background thread,
+# serving a loading page (and 503 from /ready and /api) until the data and figure caches are ready
+BACKGROUND_LOADING = os.environ.get('CO2_BACKGROUND_LOAD', '0') == '1'
+# address and number of worker processes used when serving the dashboard with gunicorn (see gunicorn.conf.py)
+WEB_BIND = os.environ.get('CO2_WEB_BIND', '0.0.0.0:1599')
+WEB_WORKERS = int(os.environ.get('CO2_WEB_WORKERS', 4))
@@ -0,0 +1,118 @@
+import itertools
+
+import numpy as np
+import pandas as pd
+
+from functions import EMISSIONS
+
+# the dimensions of the aggregation cube, in the order of the levels of every rollup
+DIMENSIONS = ['Year', 'State', 'Industry Type (sectors)', 'Primary NAICS Code', 'Power Plant']
+# the measures of every cell of the cube and how the cells are combined when a dimension is rolled up
+MEASURES = {'Facility Count': 'sum', EMISSIONS: 'sum',
+            'Smallest CO2 emissions (non-biogenic)': 'min', 'Largest CO2 emissions (non-biogenic)': 'max'}
+# the columns of every cell of the cube besides its measures
+CELL_COLUMNS = DIMENSIONS + ['State Name']
+
+
+def cube_cells(data):
+    """
+    Group the facility emissions into the cells of the aggregation cube
+
+    Function takes a dataframe from functions.facility_locations (or any frame with its DIMENSIONS,
+    State Name and emissions columns) and groups the facilities once by all of the DIMENSIONS,
+    finding the facility count, the sum of the emissions and the smallest and largest emissions of every cell
+    Every measure combines across cells (see combine_cells), so the cells of separate chunks or years
+    can be found on their own and combined later
+
+    Returns:
+    A dataframe with a column for each of the DIMENSIONS, the State Name and each of the MEASURES, one row per cell
+    """
+    # group by the categoricals of the compact frame as they are (observed=True leaves out the empty cells),
+    # so the text dimensions of every rollup stay categoricals and each distinct value is stored once;
+    # the state name follows from the state, so grouping by it as well does not add any cells
+    return data.groupby(CELL_COLUMNS, observed=True).agg(
+        **{'Facility Count': (EMISSIONS, 'size'), EMISSIONS: (EMISSIONS, 'sum'),
+           'Smallest CO2 emissions (non-biogenic)': (EMISSIONS, 'min'),
+           'Largest CO2 emissions (non-biogenic)': (EMISSIONS, 'max')}).reset_index()
+
+
+def combine_cells(cells):
+    """
+    Combine the cells from cube_cells of several chunks of the same facilities
+
+    Input is a dataframe of the stacked cells, in which the same cell can appear more than once
+
+    Returns:
+    A dataframe of the cells in the form of cube_cells, with every cell once
+    """
+    return cells.groupby(CELL_COLUMNS, observed=True).agg(MEASURES).reset_index()
+
+
+def build_cube(cells):
+    """
+    Build the aggregation cube of the facility emissions over year, state, industry sector, NAICS code and power plant
+
+    Function takes a dataframe of cells from cube_cells (for every year) and
+        Indexes the cells by all of the DIMENSIONS
+        Rolls the cells up to every subset of the dimensions (32 rollups, down to the grand total),
+        each one from the cells instead of the facilities
+    The Power Plant dimension follows from the NAICS code (see functions.classify_facilities),
+    so it does not add any cells, but gives the power plant breakdowns a rollup of their own
+
+    Returns:
+    A dictionary with:
+        rollups: a dictionary from each tuple of dimensions (in the order of DIMENSIONS) to a dataframe
+        with a column for each of those dimensions and each of the MEASURES, sorted by the dimensions
+        state_names: a series of the state name of every state abbreviation
+    """
+    state_names = cells[['State', 'State Name']].drop_duplicates('State').astype(object)
+    cells = cells.drop(columns='State Name').set_index(DIMENSIONS)
+    rollups = {}
+    for size in range(len(DIMENSIONS) + 1):
+        for dimensions in itertools.combinations(DIMENSIONS, size):
+            if not dimensions: # the grand total, as a dataframe of one row
+                rollups[dimensions] = cells.agg(MEASURES).to_frame().T.astype(cells.dtypes)
+                continue
+            rollup = cells if size == len(DIMENSIONS) else cells.groupby(level=list(dimensions), observed=True).agg(MEASURES)
+            # observed=True can leave the groups of categoricals in order of appearance, so sort them explicitly
+            rollups[dimensions] = rollup.sort_index().reset_index()
+    return {'rollups': rollups, 'state_names': state_names.set_index('State')['State Name']}
+
+
+def slice_cube(cube, by=(), where=None):
+    """
+    Slice the aggregation cube
+
+    Input is a cube from build_cube, the dimensions to break the measures down by
+    and a dictionary of the value to keep for any other dimensions, for example
+        slice_cube(cube, by=['Year', 'State'], where={'Power Plant': True})
+    gives the power plant count and emissions of every state and year
+    The answer is read from the rollup of exactly those dimensions, so no facilities are touched
+    and the time taken does not grow with the number of facilities (only with the number of distinct
+    values of the dimensions); the where values are compared to the columns of the rollup in one vectorized pass
+
+    Returns:
+    A dataframe with a column for each dimension in by (with plain values, not categoricals) and for each of the MEASURES,
+    with one row per combination of the by dimensions found in the slice, in sorted order
+    """
+    where = where or {}
+    dimensions = tuple(dimension for dimension in DIMENSIONS if dimension in by or dimension in where)
+    rollup = cube['rollups'][dimensions]
+    selected = np.ones(len(rollup), dtype=bool)
+    for dimension, value in where.items():
+        column = rollup[dimension]
+        if column.dtype == 'category': # compare the codes, without decoding the categories
+            code = column.cat.categories.get_indexer([value])[0]
+            # a value that is not a category matches no rows (code -1 marks the missing values)
+            selected &= (column.cat.codes.to_numpy() == code) if code != -1 else False
+        else:
+            selected &= column.to_numpy() == value
+    positions = np.flatnonzero(selected)
+    columns = {}
+    for column in list(by) + list(MEASURES):
+        values = rollup[column]
+        if values.dtype == 'category': # decode only the selected rows
+            columns[column] = values.cat.categories.to_numpy(dtype=object)[values.cat.codes.to_numpy()[positions]]
+        else:
+            columns[column] = values.to_numpy()[positions]
+    return pd.DataFrame(columns)
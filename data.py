@@ -1,7 +1,17 @@
-import numpy as np
+import hashlib
+import threading
+import traceback
+
 import pandas as pd
 
-from functions import import_and_clean, fill_na_values, power_plants_data, top_5_states, state_facility_data, power_plant_emissions_per_state_year
+from cache import load_manifest
+from config import DATASETS_DIR, INGEST_WORKERS, SPATIAL_CELL_DEGREES, CLUSTER_ZOOM_LEVELS
+from cube import build_cube, slice_cube
+from functions import top_5_states, index_facilities, power_plants_data, power_plant_emissions_per_state_year
+from ingest import discover_datasets, dataset_entries, load_years
+from metrics import timed_stage
+from spatial import build_spatial_index, build_cluster_levels
+from trends import build_facility_matrix
 
 # define the states in this analysis
 states = ["Alabama", "Alaska", "Arizona", "Arkansas", "California",
@@ -16,152 +26,214 @@ states = ["Alabama", "Alaska", "Arizona", "Arkansas", "California",
         "Texas", "Utah", "Vermont", "Virginia", "Washington",
         "West Virginia", "Wisconsin", "Wyoming"]
 
-# import 2011 data
-data_2011 = import_and_clean('datasets\direct_emitters2011.csv')
-data_2011 = fill_na_values(data_2011)
-
-# import 2012 data
-data_2012 = import_and_clean('datasets\direct_emitters2012.csv')
-data_2012 = fill_na_values(data_2012)
-
-# Import 2013 data
-data_2013 = import_and_clean('datasets\direct_emitters2013.csv')
-data_2013 = fill_na_values(data_2013)
-
-# Import 2014 data
-data_2014 = import_and_clean('datasets\direct_emitters2014.csv')
-data_2014 = fill_na_values(data_2014)
-
-# Import 2015 data
-data_2015 = import_and_clean('datasets\direct_emitters2015.csv')
-data_2015 = fill_na_values(data_2015)
-
-# Import 2016 data
-data_2016 = import_and_clean('datasets\direct_emitters2016.csv')
-data_2016 = fill_na_values(data_2016)
-
-# Import 2017 Data
-data_2017 = import_and_clean('datasets\direct_emitters2017.csv')
-data_2017 = fill_na_values(data_2017)
-
-# Import 2018 data
-data_2018 = import_and_clean('datasets\direct_emitters2018.csv')
-data_2018 = fill_na_values(data_2018)
-
-# Import 2019 data
-data_2019 = import_and_clean('datasets\direct_emitters2019.csv')
-data_2019 = fill_na_values(data_2019)
-
-# Import 2020 CO2 emissions data
-data_2020 = import_and_clean('datasets\direct_emitters2020.csv')
-data_2020 = fill_na_values(data_2020)
-
-
-# create dataframe of all data
-# all_data = pd.concat([data_2020,
-#                       data_2019,
-#                       data_2018,
-#                       data_2017,
-#                       data_2016,
-#                       data_2015,
-#                       data_2014,
-#                       data_2013,
-#                       data_2012,
-#                       data_2011], axis=0)
-
-
-# find all power plant data per year
-power_plants_2011 = power_plants_data(data_2011, 2011)
-power_plants_2012 = power_plants_data(data_2012, 2012)
-power_plants_2013 = power_plants_data(data_2013, 2013)
-power_plants_2014 = power_plants_data(data_2014, 2014)
-power_plants_2015 = power_plants_data(data_2015, 2015)
-power_plants_2016 = power_plants_data(data_2016, 2016)
-power_plants_2017 = power_plants_data(data_2017, 2017)
-power_plants_2018 = power_plants_data(data_2018, 2018)
-power_plants_2019 = power_plants_data(data_2019, 2019)
-power_plants_2020 = power_plants_data(data_2020, 2020)
-power_plant_state_year = pd.concat([power_plants_2011,
-                                 power_plants_2012,
-                                 power_plants_2013,
-                                 power_plants_2014,
-                                 power_plants_2015,
-                                 power_plants_2016,
-                                 power_plants_2017,
-                                 power_plants_2018,
-                                 power_plants_2019,
-                                 power_plants_2020], axis=0)
-
-# find the total power plant co2 emissions emitted across the U.S. in 2020
-total2020_power_plant_emissions = power_plants_2020['CO2 emissions (non-biogenic)'].sum()
-data_2020_power_plants_total = pd.DataFrame({'Total Power Plant Emissions': [total2020_power_plant_emissions]}) # create dataframe
-data_2020_power_plants_total['Total Power Plant Emissions'] = data_2020_power_plants_total['Total Power Plant Emissions'].round(2) # round to two decimal places
-
-# find top 5 emitting states across all years
-top_emitting_states = top_5_states(power_plant_state_year)
-
-# find total emissions for each year across the united states
-total_emissions_per_year = power_plant_state_year.groupby('Year').sum('CO2 emissions (non-biogenic)').reset_index()
-# find total facilities for each year across the united states
-total_facilities_per_year = power_plant_state_year.groupby('Year').sum('Facility Count').reset_index()
-
-# find the change in emissions from 2011 to 2020
-initial_emissions = total_emissions_per_year.loc[total_emissions_per_year['Year'] == 2011, 'CO2 emissions (non-biogenic)'].values[0]
-end_emissions = total_emissions_per_year.loc[total_emissions_per_year['Year'] == 2020, 'CO2 emissions (non-biogenic)'].values[0]
-emissions_change_calculation = end_emissions - initial_emissions
-emissions_change = abs(emissions_change_calculation.round(2)) # round to 2 decimals
-
-# find all state facility data per year
-state_facilities2011 = state_facility_data(data_2011, 2011)
-state_facilities2012 = state_facility_data(data_2012, 2012)
-state_facilities2013 = state_facility_data(data_2013, 2013)
-state_facilities2014 = state_facility_data(data_2014, 2014)
-state_facilities2015 = state_facility_data(data_2015, 2015)
-state_facilities2016 = state_facility_data(data_2016, 2016)
-state_facilities2017 = state_facility_data(data_2017, 2017)
-state_facilities2018 = state_facility_data(data_2018, 2018)
-state_facilities2019 = state_facility_data(data_2019, 2019)
-state_facilities2020 = state_facility_data(data_2020, 2020)
-top_state_facilities_per_year = pd.concat([state_facilities2011,
-                     state_facilities2012,
-                     state_facilities2013,
-                     state_facilities2014,
-                     state_facilities2015,
-                     state_facilities2016,
-                     state_facilities2017,
-                     state_facilities2018,
-                     state_facilities2019,
-                     state_facilities2020], axis=0)
-
-# count how many power plant facilities across the U.S. in 2020
-total_state_facilities_2020 = state_facilities2020['Facility Name'].count()
-
-# find change in facilities from 2011 to 2020
-initial_facilities = total_emissions_per_year.loc[total_emissions_per_year['Year'] == 2011, 'Facility Count'].values[0]
-end_facilities = total_emissions_per_year.loc[total_emissions_per_year['Year'] == 2020, 'Facility Count'].values[0]
-facilities_change_calculation = end_facilities - initial_facilities
-facilities_change = abs(facilities_change_calculation.round(2)) # round to 2 decimals
-
-# find the power plant emissions totals per year
-emission_sums2011 = power_plant_emissions_per_state_year(data_2011, 2011)
-emission_sums2012 = power_plant_emissions_per_state_year(data_2012, 2012)
-emission_sums2013 = power_plant_emissions_per_state_year(data_2013, 2013)
-emission_sums2014 = power_plant_emissions_per_state_year(data_2014, 2014)
-emission_sums2015 = power_plant_emissions_per_state_year(data_2015, 2015)
-emission_sums2016 = power_plant_emissions_per_state_year(data_2016, 2016)
-emission_sums2017 = power_plant_emissions_per_state_year(data_2017, 2017)
-emission_sums2018 = power_plant_emissions_per_state_year(data_2018, 2018)
-emission_sums2019 = power_plant_emissions_per_state_year(data_2019, 2019)
-emission_sums2020 = power_plant_emissions_per_state_year(data_2020, 2020)
-emission_sums_by_state = pd.concat([emission_sums2011,
-                                  emission_sums2012,
-                                  emission_sums2013,
-                                  emission_sums2014,
-                                  emission_sums2015,
-                                  emission_sums2016,
-                                  emission_sums2017,
-                                  emission_sums2018,
-                                  emission_sums2019,
-                                  emission_sums2020], axis=0)
+# find the years in this analysis and the csv file for each year (every direct_emitters<year>.csv in the datasets directory)
+datasets = discover_datasets(DATASETS_DIR)
+years = list(datasets)
+files = list(datasets.values())
+first_year, latest_year = years[0], years[-1]
+
+# the derived tables are only computed the first time they are accessed (see __getattr__ below)
+builders = {}
+lock = threading.RLock()
+# set once the dashboard can be served with its data (see start_background_load), reported at /ready
+ready = threading.Event()
+# the exception that stopped the background load, if any
+load_error = None
+
+
+def builds(name):
+    """
+    Register the decorated function as the builder of the named module attribute
+    """
+    def register(builder):
+        builders[name] = builder
+        return builder
+    return register
+
+
+def __getattr__(name):
+    """
+    Compute a derived table on first access
+
+    Python calls this function when an attribute is not found on the module
+    The table is built with its registered builder and stored as a module global,
+    so later accesses return it directly without calling this function again
+
+    Returns:
+    The value of the derived table
+    """
+    if name not in builders:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    with lock:
+        if name not in globals(): # another thread may have built it while this one waited
+            with timed_stage(f'build_{name}'):
+                globals()[name] = builders[name]()
+    return globals()[name]
+
+
+def __dir__():
+    return sorted(set(globals()) | set(builders))
+
+
+def load_all():
+    """
+    Build every derived table that has not been built yet
+
+    Used before forking web workers, so the workers share the tables instead of each building their own
+    """
+    for name in builders:
+        __getattr__(name)
+
+
+def start_background_load(warm_up=None):
+    """
+    Build every derived table in a background thread, so the web server can start before the data is loaded
+
+    Input is an optional function run after the tables are built, such as figures.build_figure_caches
+    The ready event is set once both are done; until then anything that reads a table waits for it under the lock
+    If loading fails, the exception is kept in load_error and the ready event is never set
+
+    Returns:
+    The started thread
+    """
+    def load():
+        global load_error
+        try:
+            load_all()
+            if warm_up is not None:
+                warm_up()
+        except Exception as error:
+            load_error = error
+            traceback.print_exc()
+        else:
+            ready.set()
+
+    thread = threading.Thread(target=load, name='co2-data-load', daemon=True)
+    thread.start()
+    return thread
+
+
+@builds('combined_tables')
+def run_pipeline():
+    # run the pipeline for every new or changed year (reading one csv file per worker process and aggregating
+    # all of them in one pass), and load the other years from the cache
+    return load_years(files, years, workers=INGEST_WORKERS)
+
+
+@builds('dataset_version')
+def build_dataset_version():
+    # identify the loaded data by the keys of its years, so anything built from it can be cached per version
+    digest = hashlib.sha256()
+    for year, entry in dataset_entries(files, years, load_manifest()).items():
+        digest.update(f"{year}:{entry['key']}".encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+
+@builds('emissions_cube')
+def build_emissions_cube():
+    # roll the emissions of every facility by year, state, sector, NAICS code and power plant up every way
+    return build_cube(__getattr__('combined_tables')[2])
+
+
+@builds('power_plant_state_year')
+def build_power_plant_state_year():
+    # find all power plant data per year
+    return power_plants_data(__getattr__('emissions_cube'))
+
+
+@builds('latest_year_power_plants_total')
+def build_power_plants_total():
+    # find the total power plant co2 emissions emitted across the U.S. in the latest year
+    latest_power_plants = slice_cube(__getattr__('emissions_cube'), where={'Year': latest_year, 'Power Plant': True})
+    latest_power_plant_emissions = latest_power_plants['CO2 emissions (non-biogenic)'].sum()
+    latest_year_power_plants_total = pd.DataFrame({'Total Power Plant Emissions': [latest_power_plant_emissions]}) # create dataframe
+    latest_year_power_plants_total['Total Power Plant Emissions'] = latest_year_power_plants_total['Total Power Plant Emissions'].round(2) # round to two decimal places
+    return latest_year_power_plants_total
+
+
+@builds('top_emitting_states')
+def build_top_emitting_states():
+    # find top 5 emitting states across all years
+    return top_5_states(__getattr__('power_plant_state_year'))
+
+
+@builds('total_emissions_per_year')
+def build_total_emissions_per_year():
+    # find total power plant facilities and emissions for each year across the united states
+    return slice_cube(__getattr__('emissions_cube'), by=['Year'], where={'Power Plant': True})[['Year', 'Facility Count', 'CO2 emissions (non-biogenic)']]
+
+
+@builds('total_facilities_per_year')
+def build_total_facilities_per_year():
+    # the yearly totals hold the facility counts as well, so both names share one table
+    return __getattr__('total_emissions_per_year')
+
+
+@builds('emissions_change')
+def build_emissions_change():
+    # find the change in emissions from the first year to the latest year
+    total_emissions_per_year = __getattr__('total_emissions_per_year')
+    initial_emissions = total_emissions_per_year.loc[total_emissions_per_year['Year'] == first_year, 'CO2 emissions (non-biogenic)'].values[0]
+    end_emissions = total_emissions_per_year.loc[total_emissions_per_year['Year'] == latest_year, 'CO2 emissions (non-biogenic)'].values[0]
+    emissions_change_calculation = end_emissions - initial_emissions
+    return abs(emissions_change_calculation.round(2)) # round to 2 decimals
+
+
+@builds('top_state_facilities_per_year')
+def build_top_state_facilities_per_year():
+    # find all state facility data per year
+    return __getattr__('combined_tables')[0]
+
+
+@builds('state_year_index')
+def build_state_year_index():
+    # find the top facilities, map center and bounds for every state and year
+    return index_facilities(__getattr__('top_state_facilities_per_year'))
+
+
+@builds('total_state_facilities_latest_year')
+def build_total_state_facilities_latest_year():
+    # count how many power plant facilities across the U.S. in the latest year
+    top_state_facilities_per_year = __getattr__('top_state_facilities_per_year')
+    return top_state_facilities_per_year.loc[top_state_facilities_per_year['Year'] == latest_year, 'Facility Name'].count()
+
+
+@builds('facilities_change')
+def build_facilities_change():
+    # find change in facilities from the first year to the latest year
+    total_facilities_per_year = __getattr__('total_facilities_per_year')
+    initial_facilities = total_facilities_per_year.loc[total_facilities_per_year['Year'] == first_year, 'Facility Count'].values[0]
+    end_facilities = total_facilities_per_year.loc[total_facilities_per_year['Year'] == latest_year, 'Facility Count'].values[0]
+    facilities_change_calculation = end_facilities - initial_facilities
+    return abs(facilities_change_calculation.round(2)) # round to 2 decimals
+
+
+@builds('emission_sums_by_state')
+def build_emission_sums_by_state():
+    # find the power plant emissions totals per year
+    return power_plant_emissions_per_state_year(__getattr__('emissions_cube'))
+
+
+@builds('facility_locations')
+def build_facility_locations():
+    # find the location of every facility per year
+    return __getattr__('combined_tables')[1]
+
+
+@builds('spatial_index')
+def build_facility_spatial_index():
+    # index the facilities of every year by latitude and longitude for the radius, box and nearest queries
+    return build_spatial_index(__getattr__('facility_locations'), cell_degrees=SPATIAL_CELL_DEGREES)
+
+
+@builds('facility_clusters')
+def build_facility_clusters():
+    # cluster the power plants of every year at every zoom level of the facility map, each with its own spatial index
+    facility_locations = __getattr__('facility_locations')
+    return build_cluster_levels(facility_locations[facility_locations['Power Plant']], CLUSTER_ZOOM_LEVELS)
 
 
+@builds('facility_matrix')
+def build_facility_emissions_matrix():
+    # line up the emissions of every facility across the years by facility id, for the per-facility trends
+    return build_facility_matrix(__getattr__('facility_locations'))
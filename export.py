@@ -0,0 +1,211 @@
+"""
+Export the dashboard figures to static files, without running the dashboard
+
+Run with:
+    python export.py
+    python export.py --output exports --formats html json png --workers 4
+    python export.py --states Texas Ohio --years 2019 2020
+
+Renders, with the same figure code as the dashboard callbacks (see figures.py):
+    the facility map of every state and year (update_state_map): states/<state>/facilities-<year>.<format>
+    the bar charts of every graph type, year and top or bottom states (update_graph): national/<graph>-<states>-<year>.<format>
+    the choropleth map of every year (update_choropleth_map): national/choropleth.<format>
+The figures are rendered in a pool of worker processes, forked after the data is loaded so the workers share it
+Every written file is recorded in export-manifest.json in the output directory with a key of the data it shows,
+the figure code and the plotly version, so a rerun only renders the files whose inputs changed
+Image formats (png, svg, pdf) need the kaleido package (pip install kaleido)
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import plotly
+import plotly.graph_objects as go
+import plotly.io as pio
+
+import data
+import figures
+from cache import file_checksum, load_manifest as load_dataset_manifest
+from ingest import dataset_entries
+
+# the file in the output directory that records the key of every exported file
+MANIFEST_FILE = 'export-manifest.json'
+# the formats that are written as text and the formats that are rendered to images with kaleido
+TEXT_FORMATS = ['html', 'json']
+IMAGE_FORMATS = ['png', 'svg', 'pdf']
+# the plotly.js bundle shared by every html file, written once at the top of the output directory
+PLOTLY_JS = 'plotly.min.js'
+
+
+def slug(text):
+    """
+    Turn a name such as 'New York' or 'Non-Biogenic CO2 Emissions' into a file name such as 'new-york'
+
+    Returns:
+    The name in lower case, with every run of other characters than letters and digits replaced by a dash
+    """
+    return re.sub(r'[^a-z0-9]+', '-', str(text).lower()).strip('-')
+
+
+def export_jobs(states, years):
+    """
+    List the figures to export
+
+    Returns:
+    A list of (kind, arguments, path) tuples, where the path has no extension and is relative to the output directory
+    """
+    jobs = [('state_map', (state, year), os.path.join('states', slug(state), f'facilities-{year}'))
+            for state in states for year in years]
+    jobs += [('bar_chart', (graph, year, results), os.path.join('national', f'{slug(graph)}-{slug(results)}-{year}'))
+             for graph in figures.BAR_CHARTS for results in ('Top States', 'Bottom States') for year in years]
+    jobs.append(('choropleth', (), os.path.join('national', 'choropleth')))
+    return jobs
+
+
+def build_figure(kind, arguments):
+    """
+    Build the figure of an export job with the functions behind the dashboard callbacks
+
+    Returns:
+    The plotly figure
+    """
+    if kind == 'state_map':
+        return figures.state_map_figure(*arguments)
+    # the dictionary figures are built for dash, which leaves out properties plotly does not know (such as the
+    # opacity of the bar outlines), so skip them the same way
+    if kind == 'bar_chart':
+        return go.Figure(figures.bar_chart_figure(*arguments), skip_invalid=True)
+    return go.Figure(figures.choropleth_figure(), skip_invalid=True)
+
+
+def write_file(path, content):
+    """
+    Write a file under a temporary name first and then rename it, so readers never see a partial file
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary_path = f'{path}.{os.getpid()}.tmp'
+    with open(temporary_path, 'wb') as output:
+        output.write(content.encode('utf-8') if isinstance(content, str) else content)
+    os.replace(temporary_path, path)
+
+
+def render_job(job, formats, output):
+    """
+    Build the figure of an export job and write it in each of the formats
+
+    Input is the (kind, arguments, path) job from export_jobs, the formats to write and the output directory
+    The html files load the shared plotly.js bundle (PLOTLY_JS) instead of each embedding their own copy
+
+    Returns:
+    The list of paths written, relative to the output directory
+    """
+    kind, arguments, path = job
+    figure = build_figure(kind, arguments)
+    written = []
+    for file_format in formats:
+        file_path = f'{path}.{file_format}'
+        if file_format == 'html':
+            bundle = os.path.relpath(os.path.join(output, PLOTLY_JS), os.path.dirname(os.path.join(output, file_path)))
+            content = pio.to_html(figure, include_plotlyjs=bundle.replace(os.sep, '/'))
+        elif file_format == 'json':
+            content = figure.to_json()
+        else:
+            content = pio.to_image(figure, format=file_format)
+        write_file(os.path.join(output, file_path), content)
+        written.append(file_path)
+    return written
+
+
+def export_key(job, file_format, data_version, code_version):
+    return hashlib.sha256(f'{data_version}|{code_version}|{job[0]}|{job[1]}|{file_format}'.encode('utf-8')).hexdigest()[:16]
+
+
+def load_manifest(output):
+    try:
+        with open(os.path.join(output, MANIFEST_FILE)) as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def export(output, formats, states, years, workers=1, force=False):
+    """
+    Export the figures of the states and years in the formats, skipping the files that are already up to date
+
+    The key of a file (see export_key) combines the version of the data it shows, the source of figures.py
+    and the plotly version; the state maps and bar charts of a year only show that year, so they use the key
+    of the year (see ingest.dataset_entries) and are left alone when another year is added or changed,
+    while the choropleth shows every year and uses data.dataset_version
+    A file is rendered again when its key is not in the manifest or the file is missing
+    The data and figure caches are built before the pool is forked, like gunicorn.conf.py does for the web workers
+
+    Returns:
+    A tuple of the number of files written and skipped
+    """
+    code_version = f'{file_checksum(figures.__file__)}|{plotly.__version__}'
+    year_versions = {int(year): entry['key'] for year, entry in dataset_entries(data.files, data.years, load_dataset_manifest()).items()}
+    manifest = {} if force else load_manifest(output)
+    keys = {}
+    pending = []
+    for job in export_jobs(states, years):
+        job_formats = []
+        for file_format in formats:
+            file_path = f'{job[2]}.{file_format}'
+            data_version = data.dataset_version if job[0] == 'choropleth' else year_versions[job[1][1]]
+            keys[file_path] = export_key(job, file_format, data_version, code_version)
+            if manifest.get(file_path) != keys[file_path] or not os.path.exists(os.path.join(output, file_path)):
+                job_formats.append(file_format)
+        if job_formats:
+            pending.append((job, job_formats))
+    if 'html' in formats and not os.path.exists(os.path.join(output, PLOTLY_JS)):
+        write_file(os.path.join(output, PLOTLY_JS), plotly.offline.get_plotlyjs())
+
+    written = []
+    if pending:
+        data.load_all()
+        figures.build_figure_caches()
+        if workers <= 1 or 'fork' not in multiprocessing.get_all_start_methods():
+            for job, job_formats in pending:
+                written += render_job(job, job_formats, output)
+        else:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')) as executor:
+                jobs, job_formats = zip(*pending)
+                for paths in executor.map(render_job, jobs, job_formats, [output] * len(jobs), chunksize=8):
+                    written += paths
+    # record the files written now along with the files that were already up to date
+    manifest.update({file_path: keys[file_path] for file_path in written})
+    write_file(os.path.join(output, MANIFEST_FILE), json.dumps(manifest, indent=2, sort_keys=True))
+    return len(written), len(keys) - len(written)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export the CO2 emissions dashboard figures to static files')
+    parser.add_argument('--output', default='exports', help='directory for the exported files (default: exports)')
+    parser.add_argument('--formats', nargs='+', default=['html', 'json'], choices=TEXT_FORMATS + IMAGE_FORMATS,
+                        help='file formats to write (default: html json)')
+    parser.add_argument('--states', nargs='+', default=data.states, help='states to export (default: every state)')
+    parser.add_argument('--years', nargs='+', type=int, default=data.years, help='years to export (default: every year)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='number of worker processes (default: one per CPU core)')
+    parser.add_argument('--force', action='store_true', help='render every file again, even if it is up to date')
+    args = parser.parse_args()
+    if set(args.formats) & set(IMAGE_FORMATS):
+        try:
+            import kaleido # noqa: F401 (only needed by pio.to_image)
+        except ImportError:
+            parser.error('image formats need the kaleido package: pip install kaleido')
+    unknown = [state for state in args.states if state not in data.states] + [year for year in args.years if year not in data.years]
+    if unknown:
+        parser.error(f'unknown states or years: {unknown}')
+
+    start = time.perf_counter()
+    written, skipped = export(args.output, args.formats, args.states, args.years, workers=args.workers, force=args.force)
+    print(f'Exported {written} files to {args.output} ({skipped} up to date) in {time.perf_counter() - start:.1f} s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,383 @@
+import json
+import math
+from functools import lru_cache
+
+import plotly.express as px
+
+import data
+from config import VIEWPORT_FACILITIES
+from functions import POWER_PLANT_TYPES, decode_categories
+from spatial import query_bbox, positions_in_box, facilities_at
+from trends import emission_changes, facility_trend
+
+# the settings of the bar chart for each graph type
+BAR_CHARTS = {
+    'Facility Count': {'column': 'Facility Count', 'title': 'Total Facilities Per State in {year}',
+                       'yaxis': 'Total Facilities', 'color': '#abaff8', 'line_color': '#340447'},
+    'Non-Biogenic CO2 Emissions': {'column': 'CO2 emissions (non-biogenic)', 'title': 'Total Non-Biogenic CO2 Emissions Per State in {year}',
+                                   'yaxis': 'Non-Biogenic CO2 Emissions (MMmt)', 'color': '#98D0EB', 'line_color': '#1C5699'}
+}
+
+
+@lru_cache(maxsize=128)
+def bar_chart_figure(selected_graph, selected_year, selected_results):
+    """
+    Build the bar chart of facility counts or non-biogenic co2 emissions for a year
+
+    Input is the graph type (Facility Count or Non-Biogenic CO2 Emissions), the year
+    and whether to show the top 25 or bottom 25 states (Top States or Bottom States)
+
+    The figure is memoized, so each combination of inputs only touches pandas once
+    The values are converted to lists, so the cached figure is ready to be serialized
+
+    Returns:
+    The figure as a dictionary, or an empty dictionary for an unknown graph type or result
+    """
+    if selected_graph not in BAR_CHARTS or selected_results not in ('Top States', 'Bottom States'):
+        return {}
+    chart = BAR_CHARTS[selected_graph]
+    power_plant_state_year = data.power_plant_state_year
+    filtered_df = power_plant_state_year[power_plant_state_year['Year'] == selected_year]
+    if selected_results == 'Top States':
+        selected_states = filtered_df.nlargest(25, chart['column'])
+    else:
+        selected_states = filtered_df.nsmallest(25, chart['column'])
+    sorted_states = selected_states.sort_values(by=chart['column'], ascending=False, kind='mergesort') # ties stay in order of power_plant_state_year
+    return {
+        'data': [{'x': sorted_states['State'].tolist(), 'y': sorted_states[chart['column']].tolist(),
+                  'type': 'bar', 'name': selected_graph,
+                  'marker': {'color': chart['color'], 'line': {'color': chart['line_color'], 'width': 1.5, 'opacity': 0.8}}}],
+        'layout': {'title': chart['title'].format(year=selected_year),
+                   'xaxis': {'title': ''},
+                   'yaxis': {'title': chart['yaxis']},
+                   'plot_bgcolor': '#EDEEEE'}
+    }
+
+
+# the map settings of the facility map
+MAP_GEOS = dict(projection_scale=2.5,
+                showcoastlines=True,
+                coastlinecolor='black',
+                showland=True,
+                landcolor='#F8EEDA',
+                showrivers=True,
+                rivercolor='#AFD1F4',
+                bgcolor='#AFD1F4')
+
+# the columns shown when hovering over a facility on the facility map
+MAP_HOVER_DATA = ['Address', 'City', 'State', 'Zip Code', 'Power Plant Type', 'CO2 emissions (non-biogenic)']
+
+
+def state_map_figure(selected_state, selected_year):
+    """
+    Build the scatter plot of the top facilities of a state in a year
+
+    The facilities, map center and bounds are looked up in data.state_year_index
+    Markers are sized by CO2 emissions and colored by county
+
+    Returns:
+    The plotly figure, with an empty map if the state has no facilities in that year
+    """
+    state_year = data.state_year_index.get((selected_state, selected_year))
+    if state_year is None: # no facilities for this state and year
+        state_year = {'facilities': decode_categories(data.top_state_facilities_per_year.iloc[:0]),
+                      'center': {'lat': None, 'lon': None}}
+    filtered_df = state_year['facilities']
+    top_facilities_map = px.scatter_geo(filtered_df,
+                                        lat='Latitude',
+                                        lon='Longitude',
+                                        hover_name='Facility Name',
+                                        hover_data=MAP_HOVER_DATA,
+                                        projection='albers usa',
+                                        size='CO2 emissions (non-biogenic)',
+                                        color='County')
+    top_facilities_map.update_geos(center=state_year['center'], **MAP_GEOS)
+    return top_facilities_map
+
+
+# the view of the facility map in the 'facilities in view' mode when a state has no facilities: the lower 48 states
+DEFAULT_VIEW = {'south': 24.5, 'west': -125.0, 'north': 49.5, 'east': -66.9}
+# the approximate size of the facility map in pixels, used to turn a zoom level into the bounds of the view and back
+VIEWPORT_SIZE = {'width': 800, 'height': 450}
+
+
+def viewport_bounds(relayout_data):
+    """
+    Find the bounds of the map view after the user pans or zooms the facility map in the 'facilities in view' mode
+
+    The relayoutData of a mapbox figure holds the corners of the view (mapbox._derived)
+    and the center and zoom level of the map; the bounds are estimated from the center and zoom
+    (and VIEWPORT_SIZE) if the corners are missing
+
+    Returns:
+    A dictionary with the south, west, north and east edges of the view in degrees,
+    or None if the relayoutData is not a pan or zoom of the map
+    """
+    relayout_data = relayout_data or {}
+    if 'mapbox._derived' in relayout_data:
+        corners = relayout_data['mapbox._derived']['coordinates'] # [lon, lat] of the corners, clockwise from the top left
+        latitudes = [corner[1] for corner in corners]
+        south, north, west, east = min(latitudes), max(latitudes), corners[0][0], corners[1][0]
+    elif 'mapbox.center' in relayout_data and 'mapbox.zoom' in relayout_data:
+        center, zoom = relayout_data['mapbox.center'], relayout_data['mapbox.zoom']
+        degrees_per_pixel = 360 / (512 * 2 ** zoom)
+        south = center['lat'] - degrees_per_pixel * VIEWPORT_SIZE['height'] / 2
+        north = center['lat'] + degrees_per_pixel * VIEWPORT_SIZE['height'] / 2
+        west = center['lon'] - degrees_per_pixel * VIEWPORT_SIZE['width'] / 2
+        east = center['lon'] + degrees_per_pixel * VIEWPORT_SIZE['width'] / 2
+    else:
+        return None
+    if east - west >= 360: # zoomed out past the whole globe
+        west, east = -180, 180
+    else: # bring longitudes past the 180th meridian back into -180 to 180
+        west, east = (west + 180) % 360 - 180, (east + 180) % 360 - 180
+    return {'south': max(south, -90), 'west': west, 'north': min(north, 90), 'east': east}
+
+
+def bounds_zoom(bounds):
+    """
+    Find the zoom level at which the bounds of a view fill the facility map (of VIEWPORT_SIZE pixels)
+
+    Returns:
+    The zoom level at which the wider of the two spans of the bounds fills the map (spans of at least 0.5 degrees)
+    """
+    longitude_span = (bounds['east'] - bounds['west']) % 360 or 360 # a view across the 180th meridian has west > east
+    zoom = min(math.log2(360 * VIEWPORT_SIZE['width'] / (512 * max(longitude_span, 0.5))),
+               math.log2(360 * VIEWPORT_SIZE['height'] / (512 * max(bounds['north'] - bounds['south'], 0.5))))
+    return max(0, min(zoom, 12))
+
+
+def state_view(selected_state, selected_year):
+    """
+    Find the initial view of the facility map in the 'facilities in view' mode for a state and year
+
+    The view covers the largest facilities of the state (from data.state_year_index), or DEFAULT_VIEW if it has none
+
+    Returns:
+    A tuple of the bounds of the view, its center and the zoom level that fits the bounds (see bounds_zoom)
+    """
+    state_year = data.state_year_index.get((selected_state, selected_year))
+    if state_year is None:
+        bounds = DEFAULT_VIEW
+    else:
+        bounds = {'south': state_year['bounds']['lat'][0], 'west': state_year['bounds']['lon'][0],
+                  'north': state_year['bounds']['lat'][1], 'east': state_year['bounds']['lon'][1]}
+    center = {'lat': (bounds['south'] + bounds['north']) / 2, 'lon': (bounds['west'] + bounds['east']) / 2}
+    return bounds, center, bounds_zoom(bounds)
+
+
+def viewport_map_figure(selected_state, selected_year, bounds=None):
+    """
+    Build the facility map of the 'facilities in view' mode: the power plants inside the bounds of the map view
+
+    Input is the selected state and year and the bounds of the view from viewport_bounds
+    (None for the initial view of the state from state_view)
+    The power plants in view are counted with a box query on the spatial index (data.spatial_index)
+        With at most VIEWPORT_FACILITIES of them, each power plant is drawn, sized by CO2 emissions and colored by type
+        With more, the precomputed clusters of the zoom level of the view (data.facility_clusters) are drawn instead,
+        sized by their total CO2 emissions, so the number of markers only depends on the size of the map
+        Zoomed in past the last cluster level, the VIEWPORT_FACILITIES largest power plants are drawn
+    The map keeps the view of the user while it pans and zooms (uirevision), until another state is selected
+
+    Returns:
+    The plotly figure
+    """
+    view_bounds, center, zoom = state_view(selected_state, selected_year)
+    bounds = bounds or view_bounds
+    positions = positions_in_box(data.spatial_index, **bounds, year=selected_year, power_plants_only=True)
+    level = int(bounds_zoom(bounds))
+    map_settings = dict(lat='Latitude', lon='Longitude', size='CO2 emissions (non-biogenic)',
+                        center=center, zoom=zoom, mapbox_style='carto-positron')
+    if len(positions) > VIEWPORT_FACILITIES and level < len(data.facility_clusters):
+        clusters = query_bbox(data.facility_clusters[level], **bounds, year=selected_year)
+        viewport_map = px.scatter_mapbox(clusters,
+                                         hover_name='Largest Facility',
+                                         hover_data=['Facility Count'],
+                                         color_discrete_sequence=['#1C5699'],
+                                         **map_settings)
+        title = f'{len(positions)} power plants in view, in {len(clusters)} clusters (zoom in for each power plant)'
+    else:
+        shown = facilities_at(data.spatial_index, positions).nlargest(VIEWPORT_FACILITIES, 'CO2 emissions (non-biogenic)')
+        viewport_map = px.scatter_mapbox(decode_categories(shown),
+                                         hover_name='Facility Name',
+                                         hover_data=MAP_HOVER_DATA,
+                                         color='Power Plant Type',
+                                         category_orders={'Power Plant Type': list(POWER_PLANT_TYPES.values())},
+                                         **map_settings)
+        title = f'{len(shown)} of {len(positions)} power plants in view'
+    viewport_map.update_layout(title=title,
+                               uirevision=selected_state,
+                               margin={'l': 0, 'r': 0, 'b': 0})
+    return viewport_map
+
+
+@lru_cache(maxsize=1)
+def build_choropleth_figure(dataset_version):
+    """
+    Build the animated choropleth map of the power plant emissions per state, one frame per year
+
+    Input is the version of the dataset, so the figure is built once per version and rebuilt if the data changes
+    The figure is serialized to JSON once and kept as plain lists and dictionaries,
+    so serving it skips building the figure and converting the numpy arrays again
+
+    Returns:
+    The figure as a dictionary
+    """
+    emission_sums_by_state = data.emission_sums_by_state
+    choropleth_map = px.choropleth(emission_sums_by_state,
+                        locations='State',
+                        locationmode='USA-states',
+                        color='CO2 emissions (non-biogenic)',
+                        color_continuous_scale='dense',
+                        animation_frame='Year',
+                        range_color=[emission_sums_by_state['CO2 emissions (non-biogenic)'].min(),
+                                        emission_sums_by_state['CO2 emissions (non-biogenic)'].max()],
+                        scope='usa')
+    choropleth_map.update_layout(
+        coloraxis_colorbar=dict(
+            title= 'CO2 emissions (MMmt)',
+            title_font=dict(size=10),
+            len=1,
+            thickness=10
+            )
+        )
+    return json.loads(choropleth_map.to_json())
+
+
+def choropleth_figure():
+    """
+    Find the choropleth map figure for the loaded dataset
+
+    Returns:
+    The cached figure from build_choropleth_figure
+    """
+    return build_choropleth_figure(data.dataset_version)
+
+
+# the number of facilities shown on the chart of the largest changes in emissions
+CHANGE_FACILITIES = 15
+
+
+@lru_cache(maxsize=128)
+def facility_changes_figure(selected_direction, start_year, end_year, selected_state=None):
+    """
+    Build the bar chart of the power plants whose emissions fell or rose the most between two years
+
+    Input is Decliners or Increasers, the two years and a state name (None for every state)
+    The changes are ranked by trends.emission_changes on the facility matrix; the facility id of every bar
+    is kept in its customdata, so clicking a bar can show the trend of that facility
+
+    Returns:
+    The figure as a dictionary
+    """
+    changes = emission_changes(data.facility_matrix, start_year, end_year, k=CHANGE_FACILITIES,
+                               increasers=selected_direction == 'Increasers', state=selected_state)
+    changes = changes.iloc[::-1] # the largest change at the top of the chart
+    labels = (changes['Facility Name'].astype(str) + ' (' + changes['State'].astype(str) + ')').tolist()
+    title = 'Largest {} in Power Plant Emissions, {} to {}{}'.format(
+        'Increases' if selected_direction == 'Increasers' else 'Decreases', start_year, end_year,
+        f' ({selected_state})' if selected_state else '')
+    return {
+        'data': [{'x': changes['Change'].tolist(), 'y': labels, 'type': 'bar', 'orientation': 'h',
+                  'customdata': changes['Facility Id'].tolist(),
+                  'text': [f'{percent:+.0f}%' for percent in changes['Percent Change']], 'textposition': 'auto',
+                  'hovertemplate': '%{y}<br>Change: %{x:,.0f} metric tons CO2e<extra></extra>',
+                  'marker': {'color': '#98D0EB' if selected_direction == 'Increasers' else '#abaff8',
+                             'line': {'color': '#1C5699', 'width': 1.5}}}],
+        'layout': {'title': title,
+                   'xaxis': {'title': 'Change in Non-Biogenic CO2 Emissions (metric tons CO2e)'},
+                   'yaxis': {'automargin': True},
+                   'height': 550,
+                   'plot_bgcolor': '#EDEEEE'}
+    }
+
+
+@lru_cache(maxsize=256)
+def facility_trend_figure(facility_id):
+    """
+    Build the line chart of the emissions of one facility in every year it reported
+
+    Input is a GHGRP Facility Id, looked up in the facility matrix with trends.facility_trend
+
+    Returns:
+    The figure as a dictionary, with an empty chart for an unknown facility
+    """
+    trend = facility_trend(data.facility_matrix, facility_id)
+    title = 'Select a facility on the chart of the largest changes'
+    if len(trend):
+        facility = data.facility_matrix['facilities'].iloc[data.facility_matrix['index'].get_loc(facility_id)]
+        title = f"{facility['Facility Name']}, {facility['City']}, {facility['State']}"
+    return {
+        'data': [{'x': trend['Year'].tolist(), 'y': trend['CO2 emissions (non-biogenic)'].tolist(),
+                  'type': 'scatter', 'mode': 'lines+markers',
+                  'line': {'color': '#1C5699', 'width': 4}}],
+        'layout': {'title': title,
+                   'xaxis': {'title': 'Year', 'dtick': 1},
+                   'yaxis': {'title': 'Non-Biogenic CO2 Emissions (metric tons CO2e)'},
+                   'plot_bgcolor': '#EDEEEE'}
+    }
+
+
+@lru_cache(maxsize=1)
+def build_year_switching_data(dataset_version):
+    """
+    Build the compact per-year arrays used to switch years in the browser
+
+    Input is the version of the dataset, so the arrays are built once per version
+
+    Returns:
+    A dictionary that can be stored in a dcc.Store:
+        states: for each year, the State, Facility Count and CO2 emissions columns of power_plant_state_year
+        facilities: for each year, the columns of top_state_facilities_per_year shown on the facility map
+        bar_charts: the settings of the bar chart for each graph type (BAR_CHARTS)
+        map_layout: the layout of an empty facility map, so the browser draws the same map as the server
+    """
+    power_plant_state_year = data.power_plant_state_year
+    top_state_facilities_per_year = data.top_state_facilities_per_year
+    state_columns = ['State', 'Facility Count', 'CO2 emissions (non-biogenic)']
+    facility_columns = ['State Name', 'Facility Name', 'County', 'Latitude', 'Longitude'] + MAP_HOVER_DATA
+    states = {int(year): {column: year_data[column].tolist() for column in state_columns}
+              for year, year_data in power_plant_state_year.groupby('Year')}
+    facilities = {int(year): {column: year_data[column].tolist() for column in facility_columns}
+                  for year, year_data in top_state_facilities_per_year.groupby('Year')}
+    map_layout = json.loads(state_map_figure(None, None).to_json())['layout']
+    return {'states': states, 'facilities': facilities, 'bar_charts': BAR_CHARTS, 'map_layout': map_layout}
+
+
+def year_switching_data():
+    """
+    Find the per-year arrays for the loaded dataset
+
+    Returns:
+    The cached dictionary from build_year_switching_data
+    """
+    return build_year_switching_data(data.dataset_version)
+
+
+def build_figure_caches():
+    """
+    Fill the figure caches: the choropleth map, the per-year arrays and every bar chart
+
+    Used before forking web workers, so the workers share the cached figures instead of each building their own
+    """
+    choropleth_figure()
+    year_switching_data()
+    for selected_graph in BAR_CHARTS:
+        for selected_year in data.years:
+            for selected_results in ('Top States', 'Bottom States'):
+                bar_chart_figure(selected_graph, selected_year, selected_results)
+
+
+def figure_cache_stats():
+    """
+    Find the hit and miss counts of the figure caches
+
+    Returns:
+    A dictionary with the hits, misses and current size of each figure cache
+    """
+    stats = {}
+    for figure_cache in (bar_chart_figure, build_choropleth_figure, build_year_switching_data,
+                         facility_changes_figure, facility_trend_figure):
+        info = figure_cache.cache_info()
+        stats[figure_cache.__name__] = {'hits': info.hits, 'misses': info.misses, 'size': info.currsize}
+    return stats
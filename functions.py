@@ -1,5 +1,97 @@
+import csv
+import itertools
+
 import numpy as np
 import pandas as pd
+from pandas.api.types import union_categoricals
+
+from metrics import instrument_stage, timed_stage
+
+
+# number of rows above the column headers in the GHGRP csv files
+HEADER_ROW = 3
+# the emissions column, shared by every module that aggregates it
+EMISSIONS = 'CO2 emissions (non-biogenic)'
+
+# the columns kept for analysis and the type they are read as; all other columns are never parsed
+COLUMN_TYPES = {
+    'Facility Id': float, 'FRS Id': float,
+    'Facility Name': str, 'City': str, 'State': str, 'Zip Code': float, 'Address': str, 'County': str,
+    'Latitude': float, 'Longitude': float, 'Primary NAICS Code': str, 'Industry Type (subparts)': str,
+    'Industry Type (sectors)': str, 'Total reported direct emissions': str, 'CO2 emissions (non-biogenic)': float,
+    'Other GHGs (metric tons CO2e)': str, 'Biogenic CO2 emissions (metric tons)': str
+}
+
+
+def read_header(file):
+    """
+    Read the column names of a GHGRP csv file
+
+    The column names are on the 4th line of the file, below three lines of notes
+    The empty space at the end of each column name is stripped
+
+    Returns:
+    A list of the column names
+    """
+    with open(file, encoding='utf-8-sig', newline='') as csv_file:
+        for _ in range(HEADER_ROW):
+            next(csv_file) # skip the notes above the column headers
+        header = next(csv.reader(csv_file))
+    return [column.rstrip() for column in header]
+
+
+def read_arguments(file):
+    """
+    Find the pd.read_csv arguments that read the columns needed for analysis from a GHGRP csv file
+
+    The column headers are read from the 4th line of the csv file and only the columns in COLUMN_TYPES are read,
+    skipping the lines above the data
+    The numeric columns are parsed as floats, removing the commas in the numbers
+
+    Returns:
+    A tuple of the kept columns (in the order of the file) and the keyword arguments for pd.read_csv
+    """
+    header = read_header(file)
+    # find the position of each column that is kept, in the order of the file
+    columns = [column for column in header if column in COLUMN_TYPES]
+    positions = [header.index(column) for column in columns]
+    return columns, dict(skiprows=HEADER_ROW + 1, header=None, names=header, usecols=positions,
+                         dtype={column: COLUMN_TYPES[column] for column in columns},
+                         thousands=',', float_precision='round_trip')
+
+
+@instrument_stage('read')
+def read_data(file):
+    """
+    Read the columns needed for analysis from a GHGRP csv file, using the arguments from read_arguments
+
+    Returns:
+    A dataframe with the columns in COLUMN_TYPES, in the order of the file
+    """
+    columns, arguments = read_arguments(file)
+    data = pd.read_csv(file, **arguments) # import the csv file
+    return data[columns]
+
+
+def read_chunks(file, chunk_rows):
+    """
+    Read the columns needed for analysis from a GHGRP csv file, chunk_rows rows at a time
+
+    The chunks have the same columns and types as the dataframe from read_data,
+    and their index continues from one chunk to the next, so it gives the row number within the file
+
+    Returns:
+    An iterator of dataframes with at most chunk_rows rows each
+    """
+    columns, arguments = read_arguments(file)
+    with pd.read_csv(file, chunksize=chunk_rows, **arguments) as reader:
+        while True:
+            with timed_stage('read') as counts:
+                chunk = next(reader, None)
+                counts['rows'] = 0 if chunk is None else len(chunk)
+            if chunk is None:
+                return
+            yield chunk[columns]
 
 
 def import_and_clean(file):
@@ -11,41 +103,85 @@ def import_and_clean(file):
     Returns:
     A cleaned dataframe, but may contain null values
 
+    The function reads the file with read_data and cleans it with clean_data
+    """
+    return clean_data(read_data(file))
+
+
+# the title case of every text value seen so far, shared by every year (and chunk) cleaned in this process;
+# ingest worker processes send the values they added back to the main process (see title_case_entries_since)
+TITLE_CASE_CACHE = {}
+# the most values kept in TITLE_CASE_CACHE; it is emptied when it grows past this
+TITLE_CASE_CACHE_SIZE = 1000000
+
+
+def normalize_text(values, title_case=False):
+    """
+    Convert a column of text to strings, optionally in title case, working on each distinct value once
+
+    Function factorizes the column into integer codes and its distinct values (pd.factorize, one pass over a hash table),
+    converts only the distinct values and maps them back to the rows by their codes
+    Null values become 'nan' (or 'Nan'), the same as with astype(str)
+    The title case of a value is looked up in TITLE_CASE_CACHE first, so values repeated across years are only converted once
+    by the process; the years of a parallel load are cleaned at the same time in separate worker processes,
+    which each convert their own values, and the values are merged into the main process afterwards,
+    so a later load (such as adding a new year) only converts the values that are new
+
+    Returns:
+    An object array of the converted values, in the order of the rows
+    """
+    codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+    # append the string of a null value, so that code -1 (a null value) maps to it
+    uniques = list(map(str, uniques)) + [str(np.nan)]
+    if title_case:
+        if len(TITLE_CASE_CACHE) > TITLE_CASE_CACHE_SIZE:
+            TITLE_CASE_CACHE.clear()
+        # only the values never seen before are converted; the lookups run in map instead of a python loop
+        TITLE_CASE_CACHE.update((value, value.title()) for value in set(uniques).difference(TITLE_CASE_CACHE))
+        uniques = list(map(TITLE_CASE_CACHE.__getitem__, uniques))
+    return np.array(uniques, dtype=object)[codes]
+
+
+def title_case_entries_since(size):
+    """
+    Find the values added to TITLE_CASE_CACHE since it held size values
+
+    Dictionaries keep the order values were added in, so the new values are the ones after the first size
+
+    Returns:
+    A dictionary of the new values and their title case (every value if the cache was emptied in the meantime)
+    """
+    if len(TITLE_CASE_CACHE) < size: # the cache was emptied, so every value in it is new
+        size = 0
+    return dict(itertools.islice(TITLE_CASE_CACHE.items(), size, None))
+
+
+def add_title_case_entries(entries):
+    """
+    Add values found by title_case_entries_since in another process to TITLE_CASE_CACHE
+    """
+    if len(TITLE_CASE_CACHE) + len(entries) > TITLE_CASE_CACHE_SIZE:
+        TITLE_CASE_CACHE.clear()
+    TITLE_CASE_CACHE.update(entries)
+
+
+@instrument_stage('clean')
+def clean_data(data):
+    """
+    Clean the data read from a GHGRP csv file by read_data
+
+    Returns:
+    A cleaned dataframe, but may contain null values
+
     The following function:
-        Read the csv file and skips the first two rows
-        Makes the first row the column headers and then drops index 2, which contained the header names in a row
-        Strip the empty space at the end of the column names using rstrip
-        Strip the emissions data where there are commas in the numbers
-        Drop all rows where every column is null and drop all unnecessary columns not needed for analysis
+        Drop all rows where every column is null
         Create a dictionary of the US states and their abbreviations
         Add a new column where the abbreviated state names are mapped to the full state name
         Drop the other districts/places that are not direct US states
-        Convert columns to either floats or strings
+        Convert columns to either integers or strings
         Capitalize the first letter of each word in the specified columns
+    The capitalized columns are converted with normalize_text, once per distinct value instead of once per row
     """
-    data = pd.read_csv(file) # import the csv file 
-    data = data.iloc[2:] # skip the first two rows
-    data.columns = data.iloc[0]  # make the first row the column headers
-    data = data.drop(2) # drop index 2 (it is now the column headers)
-    data.columns = data.columns.str.rstrip() # strip the empty space at the end of each column name
-    # strip the commas from the values in the column
-    data['CO2 emissions (non-biogenic)'] = data['CO2 emissions (non-biogenic)'].str.replace(',', '', regex=True)
-    # drop unnecessary columns for analysis
-    data = data.drop(['Facility Id', 'FRS Id', 'Methane (CH4) emissions', 'Nitrous Oxide (N2O) emissions', 'HFC emissions', 'PFC emissions',
-                      'SF6 emissions', 'NF3 emissions', 'Other Fully Fluorinated GHG emissions', 'HFE emissions',
-                      'Very Short-lived Compounds emissions', 'Stationary Combustion', 'Electricity Generation', 'Adipic Acid Production',
-                      'Aluminum Production', 'Ammonia Manufacturing', 'Cement Production', 'Electronics Manufacture', 'Ferroalloy Production',
-                      'Fluorinated GHG Production', 'Glass Production', 'HCFC–22 Production from HFC–23 Destruction', 'Hydrogen Production',
-                      'Iron and Steel Production', 'Lead Production', 'Lime Production', 'Magnesium Production', 'Miscellaneous Use of Carbonates',
-                      'Nitric Acid Production', 'Petroleum and Natural Gas Systems – Offshore Production', 'Petroleum and Natural Gas Systems – Processing',
-                      'Petroleum and Natural Gas Systems – Transmission/Compression', 'Petroleum and Natural Gas Systems – Underground Storage',
-                      'Petroleum and Natural Gas Systems – LNG Storage', 'Petroleum and Natural Gas Systems – LNG Import/Export', 'Petrochemical Production',
-                      'Petroleum Refining', 'Phosphoric Acid Production', 'Pulp and Paper Manufacturing', 'Silicon Carbide Production', 'Soda Ash Manufacturing',
-                      'Titanium Dioxide Production', 'Underground Coal Mines', 'Zinc Production', 'Municipal Landfills', 'Industrial Wastewater Treatment',
-                      'Manufacture of Electric Transmission and Distribution Equipment', 'Industrial Waste Landfills',
-                      'Is some CO2 collected on-site and used to manufacture other products and therefore not emitted from the affected manufacturing process unit(s)? (as reported under Subpart G or S)',
-                      'Is some CO2 reported as emissions from the affected manufacturing process unit(s) under Subpart AA, G or P collected and transferred off-site or injected (as reported under Subpart PP)?',
-                      'Does the facility employ continuous emissions monitoring?'], axis=1)
     data = data.drop(data.index[data.isna().all(axis=1)]) # drop all rows where every column contains null values
     # create a dictionary of us states and their abbreviations
     us_states = {
@@ -62,28 +198,32 @@ def import_and_clean(file):
         "WV": "West Virginia", "WI": "Wisconsin", "WY": "Wyoming", "DC": "District of Columbia"
     }
     data['State Name'] = data['State'].map(us_states) # add a new column with state names
-    data.insert(3, 'State Name', data.pop('State Name')) # move it to column 3
+    data.insert(data.columns.get_loc('State') + 1, 'State Name', data.pop('State Name')) # move it after the State column
     # drop Guam, Puerto Rico, U.S. Virgin Islands, and District of Columbia as they are not direct U.S. states
     data = data[~data['State'].isin(['GU', 'PR', 'VI', 'DC'])]
     # define columns to convert
     columns_to_convert = ['Facility Name', 'City', 'State', 'State Name', 'Address', 'County', 'Industry Type (subparts)', 'Industry Type (sectors)', 'Primary NAICS Code']
-    convert_to_floats = ['Latitude', 'Longitude', 'CO2 emissions (non-biogenic)']
-    convert_to_integers = ['Zip Code']
+    # the GHGRP Facility Id identifies a facility across the yearly files; the FRS Id (EPA Facility Registry Service)
+    # is missing for a few facilities, so it stays a float column with null values
+    convert_to_integers = ['Facility Id', 'Zip Code']
+    columns_to_capitalize = ['Facility Name', 'City', 'Address', 'County']
     # convert columns to respective type
+    # (the columns that are capitalized below are converted to strings along with their title case)
+    columns_to_convert = [column for column in columns_to_convert if column not in columns_to_capitalize]
     data[columns_to_convert] = data[columns_to_convert].astype(str)
-    data[convert_to_floats] = data[convert_to_floats].astype(float)
     data[convert_to_integers] = data[convert_to_integers].astype(int)
-    # capitalize first letter of each word in the following string columns
-    columns_to_capitalize = ['Facility Name', 'City', 'Address', 'County']
+    # capitalize first letter of each word in the following string columns, once per distinct value (see normalize_text)
     for column in columns_to_capitalize:
-        data[column] = data[column].str.title()
+        data[column] = normalize_text(data[column], title_case=True)
     return data
 
 
-def fill_na_values(data):
+@instrument_stage('fill')
+def fill_na_values(data, by=('State', 'Industry Type (sectors)')):
     """
     Fill in the null values in the non-biogenic CO2 emissions column using the grouped mean
     The grouped mean is found by grouping by state and industry type (sectors)
+    For a dataframe of several years, pass by=('Year', 'State', 'Industry Type (sectors)') to fill every year in one pass
 
     Function takes a cleaned dataframe (after running import_and_clean function)
     Function drops any null values that cannot be filled with the grouped mean
@@ -91,42 +231,67 @@ def fill_na_values(data):
     Returns:
     A dataframe with all non-biogenic CO2 emissions filled in with the mean value of the group in which it belongs
     """
-    grouped_data = data.groupby(['State', 'Industry Type (sectors)'])['CO2 emissions (non-biogenic)'].transform('mean')
+    grouped_data = data.groupby(list(by))['CO2 emissions (non-biogenic)'].transform('mean')
     data['CO2 emissions (non-biogenic)'].fillna(grouped_data, inplace=True)
     data = data.dropna(subset=['CO2 emissions (non-biogenic)'])
     return data
 
 
-def power_plants_data(data, year):
+# the NAICS codes for electric power generation (22111) and the type of power plant each one represents
+POWER_PLANT_TYPES = {
+    '221111': 'Hydroelectric', '221112': 'Fossil Fuel', '221113': 'Nuclear', '221114': 'Solar',
+    '221115': 'Wind', '221116': 'Geothermal', '221117': 'Biomass', '221118': 'Other'
+}
+
+
+@instrument_stage('classify')
+def classify_facilities(data):
+    """
+    Classify the facilities as power plants using the primary NAICS code
+
+    Function checks each unique NAICS code once instead of scanning every row
+        Power Plant is True where the primary NAICS code includes 22111
+        Power Plant Type is the type of power plant (Fossil Fuel, Solar, ...) given by the 6 digit code,
+        and is empty for the facilities that are not power plants
+
+    Returns:
+    The dataframe with the Power Plant and Power Plant Type columns added
+    """
+    codes, unique_codes = pd.factorize(data['Primary NAICS Code'])
+    unique_codes = pd.Series(unique_codes, dtype=object)
+    # return all codes that are within 22111. Case=False means it is not case-sensitive
+    is_power_plant = unique_codes.str.contains('22111', case=False).to_numpy()
+    plant_types = unique_codes.str.extract(r'(22111\d)', expand=False).map(POWER_PLANT_TYPES)
+    plant_types = plant_types.where(~is_power_plant | plant_types.notna(), 'Other').to_numpy()
+    data['Power Plant'] = is_power_plant[codes]
+    data['Power Plant Type'] = plant_types[codes]
+    return data
+
+
+@instrument_stage('aggregate_power_plants_data')
+def power_plants_data(cube):
     """
     Find the power plant emissions per year by state
 
-    Function takes a dataframe
-        Counts up how many facilities per state
-        Sum up the emissions
-        Merge the facilities counts and emissions sums on state
-        Add a new column year which represents the year that the emissions represent
+    Function takes the aggregation cube of every facility and year (see cube.build_cube)
+        Slices the power plant facility counts and summed emissions of every state and year out of the cube
+        Both come from the same rollup, without touching the facilities
 
     Returns:
-    A dataframe that contains the power plant facility counts and emissions for each state and years
+    A dataframe that contains the power plant facility counts and emissions for each state and years,
+    ordered by year and then by facility count (largest first, ties by state)
 
     Note:
     The primary NAICS code for power plants includes 22111. The following number 1-8 determines the type of power plant
     https://www.naics.com/naics-code-description/?code=22111#:~:text=22111%20%2D%20Electric%20Power%20Generation&text=This%20industry%20comprises%20establishments%20primarily,solar%20power%2C%20into%20electrical%20energy.
     """
-    # return all columns that are within this code. Case=False means it is not case-sensitive
-    power_plant_data = data[data['Primary NAICS Code'].str.contains('22111', case=False)]
-    # count how many facilities per state
-    power_plant_facilities = power_plant_data['State Name'].value_counts().reset_index(name='Count')
-    power_plant_facilities = power_plant_facilities.rename(columns={'index': 'State'}) # rename columns
-    # sum up emissions
-    power_plant_emissions = power_plant_data.groupby('State Name')['CO2 emissions (non-biogenic)'].sum().reset_index()
-    power_plant_emissions = power_plant_emissions.rename(columns={'State Name': 'State'}) # rename columns
-    # merge the data
-    power_plants = pd.merge(power_plant_facilities, power_plant_emissions, on='State')
-    power_plants = power_plants.rename(columns={'Count': 'Facility Count'}) # rename columns
-    power_plants['Year'] = year # add the year in which this data represents
-    return power_plants
+    from cube import slice_cube # cube.py imports EMISSIONS from this module
+
+    # the facility counts and emissions of the power plants (see classify_facilities) per state and year
+    power_plants = slice_cube(cube, by=['Year', 'State'], where={'Power Plant': True})
+    power_plants['State'] = power_plants['State'].map(cube['state_names']) # name the states
+    power_plants = power_plants.sort_values(['Year', 'Facility Count', 'State'], ascending=[True, False, True], kind='mergesort')
+    return power_plants[['State', 'Facility Count', 'CO2 emissions (non-biogenic)', 'Year']].reset_index(drop=True)
 
 def top_5_states(states_data):
     """
@@ -148,60 +313,198 @@ def top_5_states(states_data):
     top_states_df = ', '.join(top_states_df['State'].tolist())
     return top_states_df
 
-def state_facility_data(data, year):
+def top_k_per_group(data, column, k=30, by='State Name'):
+    """
+    Find the k rows with the largest values of a column within each group
+
+    Input is a dataframe, the column to rank by, the number of rows to keep per group
+    and the column (or list of columns) to group by, such as State Name, County or Industry Type (sectors)
+
+    Function sorts the whole dataframe once instead of filtering it for every group
+        Sort by the column in descending order (a stable sort, so ties keep their original order like nlargest)
+        Take the first k rows of each group
+        Put the groups in order and restart the index at 0 for each group
+
+    Returns:
+    A dataframe with the top k rows of every group
+    """
+    ranked = data.dropna(subset=[column]).sort_values(column, ascending=False, kind='mergesort')
+    top_rows = ranked.groupby(by, sort=False).head(k)
+    top_rows = top_rows.sort_values(by, kind='mergesort') # put the groups in order, keeping the ranking within each group
+    top_rows.index = top_rows.groupby(by, sort=False).cumcount().to_numpy() # restart the index for each group
+    return top_rows
+
+
+@instrument_stage('aggregate_state_facility_data')
+def state_facility_data(data, n=30, by='State Name'):
     """
     Find state power plant facilities data
-    Using the NAICS code to specify power plants
-
-    Function iterates through the list of states using state name
-    Using nlargest to find the top 30 largest power plant facilities per state
-    Add a new column, assigning the year in which the data represents
-    Concatenate all data into one dataframe vertically (stacking on top)
-
-    Returns:
-    A dataframe with the 30 largest power plant facilities per state amd year
-    """
-    all_states_data = []
-    states = ["Alabama", "Alaska", "Arizona", "Arkansas", "California",
-        "Colorado", "Connecticut", "Delaware", "Florida", "Georgia",
-        "Hawaii", "Idaho", "Illinois", "Indiana", "Iowa",
-        "Kansas", "Kentucky", "Louisiana", "Maine", "Maryland",
-        "Massachusetts", "Michigan", "Minnesota", "Mississippi",
-        "Missouri", "Montana", "Nebraska", "Nevada", "New Hampshire",
-        "New Jersey", "New Mexico", "New York", "North Carolina",
-        "North Dakota", "Ohio", "Oklahoma", "Oregon", "Pennsylvania",
-        "Rhode Island", "South Carolina", "South Dakota", "Tennessee",
-        "Texas", "Utah", "Vermont", "Virginia", "Washington",
-        "West Virginia", "Wisconsin", "Wyoming"
-    ]
-    for state in states:
-        state_data = data[data['State Name'] == state].copy()
-        # find power plant facilities in the corresponding state
-        state_power_plant_facilities = state_data[state_data['Primary NAICS Code'].str.contains('22111', case=False)]
-        # find the top 30 facilities
-        state_top_facilities = state_power_plant_facilities.nlargest(30, 'CO2 emissions (non-biogenic)')
-        state_top_facilities['Year'] = year # specify the year
-        state_top_facilities.reset_index(drop=True, inplace=True)
-        all_states_data.append(state_top_facilities)
-    # add all states data together
-    state_top_facilities = pd.concat(all_states_data, axis=0)
-    return state_top_facilities
-
-
-def power_plant_emissions_per_state_year(data, year):
+    Using the power plants found by classify_facilities
+
+    Function takes a dataframe of one or more years with a Year column and finds the n largest power plant
+    facilities per state (or per any other grouping given by by) and year in one pass using top_k_per_group
+
+    Returns:
+    A dataframe with the 30 largest power plant facilities per state and year
+    """
+    # find power plant facilities
+    power_plant_facilities = data[data['Power Plant']]
+    # find the top 30 facilities of each state and year
+    return top_k_per_group(power_plant_facilities, 'CO2 emissions (non-biogenic)', k=n, by=['Year', by])
+
+
+# the columns with few distinct values, stored as categoricals by compact_frame
+CATEGORY_COLUMNS = ['State', 'State Name', 'County', 'Primary NAICS Code', 'Industry Type (subparts)',
+                    'Industry Type (sectors)', 'Power Plant Type']
+# the integer columns and the narrower type that holds all of their values
+INTEGER_TYPES = {'Facility Id': 'int32', 'Zip Code': 'int32', 'Year': 'int16', 'Facility Count': 'int32'}
+
+
+def compact_frame(data):
+    """
+    Reduce the memory used by a dataframe that is kept for the life of the dashboard
+
+    Function converts the columns in CATEGORY_COLUMNS to categoricals, so each distinct value is stored once
+    and the rows only hold small integer codes, and narrows the columns in INTEGER_TYPES
+    The float columns are left as they are, since the coordinates and emissions are shown and summed at full precision
+
+    Returns:
+    The dataframe with the compact column types
+    """
+    data = data.copy()
+    for column in CATEGORY_COLUMNS:
+        if column in data.columns:
+            data[column] = data[column].astype('category')
+    for column, integer_type in INTEGER_TYPES.items():
+        if column in data.columns:
+            data[column] = data[column].astype(integer_type)
+    return data
+
+
+def combine_frames(frames):
+    """
+    Concatenate dataframes, keeping their categorical columns categorical
+
+    pd.concat turns categoricals with different categories into object columns,
+    so the categories of each categorical column are first merged across all of the dataframes
+
+    Returns:
+    The concatenated dataframe
+    """
+    frames = list(frames)
+    for column in frames[0].columns:
+        if frames[0][column].dtype == 'category':
+            categories = union_categoricals([frame[column] for frame in frames], sort_categories=True).categories
+            frames = [frame.assign(**{column: frame[column].cat.set_categories(categories)}) for frame in frames]
+    return pd.concat(frames, axis=0)
+
+
+def decode_categories(data):
+    """
+    Convert the categorical columns of a dataframe back to object columns
+
+    Used before splitting a compact frame into small per-state subsets: at a few dozen rows, the codes and categories
+    of every categorical column take more memory than references to the (shared) strings,
+    and plotly express cannot color by a categorical with unused categories
+
+    Returns:
+    The dataframe with object columns in place of the categorical columns
+    """
+    return data.astype({column: object for column in data.columns if data[column].dtype == 'category'})
+
+
+def index_facilities(data, by=('State Name', 'Year')):
+    """
+    Build a lookup of facilities keyed by state and year (or any other columns given by by)
+
+    Function groups the dataframe once and stores, for each group:
+        facilities: the rows of the group, with categorical columns decoded (see decode_categories)
+        center: the mean latitude and longitude, used to center the map
+        bounds: the smallest and largest latitude and longitude
+
+    Returns:
+    A dictionary from each (State Name, Year) key to its facilities, center and bounds
+    """
+    index = {}
+    data = decode_categories(data) # decode once, so the groups hold one block of object columns each
+    for key, group in data.groupby(list(by), sort=False):
+        index[key] = {'facilities': group,
+                      'center': {'lat': group['Latitude'].mean(), 'lon': group['Longitude'].mean()},
+                      'bounds': {'lat': [group['Latitude'].min(), group['Latitude'].max()],
+                                 'lon': [group['Longitude'].min(), group['Longitude'].max()]}}
+    return index
+
+
+@instrument_stage('aggregate_power_plant_emissions_per_state_year')
+def power_plant_emissions_per_state_year(cube):
     """
     Find all the power plant emissions for each state and year
 
-    Function uses the primary NAICS code for power plants
-    Groups the emissions by State and sums up the non-biogeic CO2 emissions
-    Assign the year in which the data represents
+    Function slices the power plants found by classify_facilities out of the aggregation cube (see cube.build_cube)
+    by year and State, with the summed non-biogeic CO2 emissions of each
 
     Returns:
     A dataframe with the total power plant CO2 emissions by state and year
     """
-    # retrieve all power plant data
-    power_plants_data = data[data['Primary NAICS Code'].str.contains('22111', case=False)]
-    # group by state and sum emissions
-    state_emission_sums = power_plants_data.groupby('State')['CO2 emissions (non-biogenic)'].sum().reset_index()
-    state_emission_sums['Year'] = year # assigns the year
-    return state_emission_sums
\ No newline at end of file
+    from cube import slice_cube # cube.py imports EMISSIONS from this module
+
+    state_emission_sums = slice_cube(cube, by=['Year', 'State'], where={'Power Plant': True})
+    return state_emission_sums[['State', 'CO2 emissions (non-biogenic)', 'Year']]
+
+
+# the columns of every facility kept for the spatial queries of spatial.py, in the order they are shown
+LOCATION_COLUMNS = ['Facility Id', 'FRS Id',
+                    'Facility Name', 'Address', 'City', 'State', 'State Name', 'Zip Code', 'County', 'Latitude', 'Longitude',
+                    'Industry Type (sectors)', 'Primary NAICS Code', 'Power Plant', 'Power Plant Type',
+                    'CO2 emissions (non-biogenic)', 'Year']
+
+
+@instrument_stage('aggregate_facility_locations')
+def facility_locations(data):
+    """
+    Find the location of every facility (not only the power plants) for the spatial index and the aggregation cube
+
+    Function takes a dataframe of one or more years classified by classify_facilities, with a Year column
+
+    Returns:
+    A dataframe with the LOCATION_COLUMNS of every facility, in the compact form of compact_frame
+    The facility names, addresses and cities repeat every year, so they are stored as categoricals as well
+    """
+    locations = compact_frame(data[LOCATION_COLUMNS])
+    return locations.astype({column: 'category' for column in ['Facility Name', 'Address', 'City']}).reset_index(drop=True)
+
+
+def stack_years(frames, years):
+    """
+    Stack the cleaned dataframes of several years into one tall dataframe
+
+    Input is a list of dataframes from import_and_clean and the year of each one
+
+    Returns:
+    A dataframe with the rows of every year (in order) and a new index,
+    classified by classify_facilities, with a Year column added after the Power Plant columns
+    """
+    data = classify_facilities(pd.concat(frames, keys=years, names=['Year', None]))
+    data['Year'] = data.index.get_level_values('Year')
+    return data.reset_index(drop=True)
+
+
+def aggregate_years(data, n=30):
+    """
+    Compute the yearly power plant aggregates of a tall dataframe from stack_years
+
+    Fills the missing emissions (grouped by year, state and sector) and then finds
+        the n largest power plants per state and year, in the compact form of compact_frame (state_facility_data)
+        the location, sector, NAICS code and emissions of every facility (facility_locations),
+        for the spatial index and the facility trends
+        the cells of the aggregation cube (cube.cube_cells), from which the cube and every aggregate of it
+        are built when the data is loaded
+
+    Returns:
+    A tuple of the three dataframes, ordered by year
+    """
+    from cube import cube_cells # cube.py imports EMISSIONS from this module
+
+    data = fill_na_values(data, by=('Year', 'State', 'Industry Type (sectors)'))
+    locations = facility_locations(data)
+    return compact_frame(state_facility_data(data, n=n)), locations, compact_frame(cube_cells(locations))
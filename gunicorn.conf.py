@@ -0,0 +1,76 @@
+"""
+Gunicorn settings for serving the dashboard with several worker processes
+
+Run with:
+    gunicorn main:server
+
+The app is imported once in the master process (preload_app) and every data table and cached figure
+is built there before the workers are forked, so the workers share those memory pages copy-on-write
+instead of each loading the datasets again, and start serving as soon as they are forked
+
+With CO2_BACKGROUND_LOAD=1 the workers are forked right away instead, and each one loads the data
+in a background thread while it serves the loading page (and 503 from /ready)
+
+Every worker records its own metrics; they are shared through files in a temporary directory,
+so /metrics reports the totals of the master and every worker whichever worker answers (see metrics.share_between_processes)
+"""
+import gc
+import shutil
+import tempfile
+
+from config import BACKGROUND_LOADING, WEB_BIND, WEB_WORKERS
+
+bind = WEB_BIND
+workers = WEB_WORKERS
+preload_app = True
+
+
+def on_starting(server):
+    """
+    Share the metrics of the master and worker processes through a temporary directory
+    """
+    import metrics
+    metrics.share_between_processes(tempfile.mkdtemp(prefix='co2-metrics-'))
+
+
+def on_exit(server):
+    import metrics
+    shutil.rmtree(metrics.shared_directory, ignore_errors=True)
+
+
+def when_ready(server):
+    """
+    Build the data and figures in the master process, just before the workers are forked
+    """
+    if BACKGROUND_LOADING: # every worker loads its own copy after it is forked (see post_fork)
+        return
+    import data
+    import figures
+    import metrics
+    data.load_all()
+    figures.build_figure_caches()
+    metrics.save_shared() # the pipeline metrics of the master process, which the workers leave out (see post_fork)
+    # move every object created so far to the permanent generation, so garbage collections in the workers
+    # do not write to the shared pages (which would copy them into each worker)
+    gc.collect()
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    """
+    Clear the metrics the new worker inherited from the master process, and start loading the data
+    in a background thread of the worker when the data is loaded in the background
+
+    Threads do not survive a fork, so the loading cannot start in the master process
+    """
+    import metrics
+    metrics.start_worker()
+    if BACKGROUND_LOADING:
+        import data
+        import figures
+
+        def warm_up():
+            figures.build_figure_caches()
+            metrics.save_shared() # report the pipeline metrics of this worker before it serves a request
+
+        data.start_background_load(warm_up=warm_up)
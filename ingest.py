@@ -0,0 +1,196 @@
+import glob
+import hashlib
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import suppress
+
+import metrics
+from cache import (load_clean_data, file_checksum, cleaning_version, aggregation_version,
+                   save_frame, load_frame, load_manifest, save_manifest, manifest_lock)
+from config import CACHE_DIR, USE_CACHE, TOP_FACILITIES, STREAM_CHUNK_ROWS
+from functions import (stack_years, aggregate_years, compact_frame, combine_frames, TITLE_CASE_CACHE,
+                       title_case_entries_since, add_title_case_entries)
+from streaming import stream_year
+
+# the yearly csv files are named after the year they hold, e.g. direct_emitters2020.csv
+DATASET_PATTERN = re.compile(r'^direct_emitters(\d{4})\.csv$')
+# the names of the three tables returned by process_years, used to name the files of each year in the cache
+YEAR_TABLES = ['state_facilities', 'facilities', 'cells']
+
+
+def discover_datasets(directory):
+    """
+    Find the yearly csv files in a directory
+
+    Every file named direct_emitters<year>.csv is a dataset for that year
+
+    Returns:
+    A dictionary of year to csv file, sorted by year
+    """
+    datasets = {}
+    for file in glob.glob(os.path.join(glob.escape(directory), 'direct_emitters*.csv')):
+        match = DATASET_PATTERN.match(os.path.basename(file))
+        if match:
+            datasets[int(match.group(1))] = file
+    if not datasets:
+        raise FileNotFoundError(f'no direct_emitters<year>.csv files found in {directory}')
+    return dict(sorted(datasets.items()))
+
+
+def prepare_year(file, year):
+    """
+    Run the part of the pipeline that reads one csv file
+
+    Function loads the cleaned data for the year (from the cache when possible);
+    the aggregates are then computed for all years at once by process_years
+    With CO2_STREAM_CHUNK_ROWS set, the csv file is streamed in chunks by stream_year instead,
+    so the whole file is never in memory, and the aggregates of the year are computed while streaming
+
+    Returns:
+    The cleaned dataframe of the year, or when streaming, a tuple of the three tables of the year
+    (in the same form as process_years)
+    """
+    if STREAM_CHUNK_ROWS:
+        state_facilities, locations, cells = stream_year(file, year, STREAM_CHUNK_ROWS, n=TOP_FACILITIES)
+        return compact_frame(state_facilities), locations, compact_frame(cells)
+    return load_clean_data(file)
+
+
+def prepare_year_in_worker(file, year):
+    """
+    Run prepare_year in a worker process
+
+    The worker starts with a copy of the metrics of the main process, so they are cleared first
+    and the metrics recorded for this year are sent back with the result
+    The worker also starts with a copy of the title case cache of the main process (see functions.normalize_text),
+    and the values it adds are sent back, so the main process can reuse them
+
+    Returns:
+    A tuple of the result of prepare_year, the metrics recorded while running it and the new title case values
+    """
+    metrics.reset()
+    cached = len(TITLE_CASE_CACHE)
+    result = prepare_year(file, year)
+    return result, metrics.snapshot(), title_case_entries_since(cached)
+
+
+def process_years(files, years, workers=1):
+    """
+    Run the full pipeline for every year
+
+    Input is a list of csv files, the list of years they represent and the number of worker processes
+    Every csv file is read and cleaned by prepare_year, optionally spread across a process pool
+    (with more than one worker, each year is sent to its own process)
+    The pool uses the fork start method, so the workers do not re-import the dashboard;
+    on platforms without fork the years are processed one after another
+    The cleaned years are then stacked into one tall dataframe and aggregated in a single pass by aggregate_years
+
+    Returns:
+    A tuple of three dataframes ordered by year: the largest power plant facilities per state and year
+    (TOP_FACILITIES of them, in the compact form of compact_frame), every facility with its location,
+    sector, NAICS code and emissions (see functions.facility_locations; empty when streaming)
+    and the cells of the aggregation cube (see cube.cube_cells), from which data.py builds the cube
+    The output is the same whether or not a pool is used
+    """
+    workers = min(workers, len(years))
+    if workers <= 1 or 'fork' not in multiprocessing.get_all_start_methods():
+        prepared = [prepare_year(file, year) for file, year in zip(files, years)]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')) as executor:
+            prepared = []
+            for result, recorded, title_cases in executor.map(prepare_year_in_worker, files, years):
+                metrics.merge(recorded) # add the metrics of the worker to the metrics of the main process
+                add_title_case_entries(title_cases)
+                prepared.append(result)
+    if STREAM_CHUNK_ROWS:
+        return tuple(combine_frames(tables) for tables in zip(*prepared))
+    return aggregate_years(stack_years(prepared, years), n=TOP_FACILITIES)
+
+
+def dataset_entries(files, years, manifest=None):
+    """
+    Describe every yearly csv file the way it is recorded in the manifest
+
+    The checksum recorded in the manifest is reused when the size and modification time of the file have not changed,
+    so unchanged files are not read again
+
+    Returns:
+    A dictionary of year (as a string) to the file name, size, modification time, checksum and key of the year
+    The key combines the checksum with the versions of the cleaning and aggregation code,
+    so the yearly tables are recomputed when any of them changes
+    """
+    manifest = manifest or {}
+    code_version = cleaning_version() + aggregation_version()
+    entries = {}
+    for file, year in zip(files, years):
+        recorded = manifest.get(str(year), {})
+        stat = os.stat(file)
+        if recorded.get('size') == stat.st_size and recorded.get('modified') == stat.st_mtime_ns:
+            checksum = recorded['checksum']
+        else:
+            checksum = file_checksum(file)
+        entries[str(year)] = {'file': os.path.basename(file), 'size': stat.st_size, 'modified': stat.st_mtime_ns,
+                              'checksum': checksum,
+                              'key': hashlib.sha256((checksum + code_version).encode('utf-8')).hexdigest()[:16]}
+    return entries
+
+
+def year_table_paths(year, key):
+    return [os.path.join(CACHE_DIR, f'aggregates{year}-{key}-{table}.npz') for table in YEAR_TABLES]
+
+
+def load_years(files, years, workers=1):
+    """
+    Find the aggregates of every year, only running the pipeline for new or changed years
+
+    The manifest in the cache directory records the checksum and key of every processed year
+    Years whose key matches the manifest are loaded from their cached tables;
+    the other years are run through process_years together, and their tables are saved and added to the manifest
+    Years that are no longer in the datasets directory are removed from the manifest and the cache
+    Without the cache (CO2_USE_CACHE=0) every year is processed
+
+    Returns:
+    The three dataframes of process_years for all of the years
+    """
+    if not USE_CACHE:
+        return process_years(files, years, workers=workers)
+    manifest = load_manifest()
+    entries = dataset_entries(files, years, manifest)
+    yearly_tables = {}
+    for year in years:
+        entry = entries[str(year)]
+        if manifest.get(str(year), {}).get('key') != entry['key']:
+            continue
+        try:
+            with metrics.timed_stage('aggregates_load'):
+                yearly_tables[year] = tuple(load_frame(path) for path in year_table_paths(year, entry['key']))
+        except OSError: # the tables were removed from the cache; process the year again
+            pass
+    new_years = [year for year in years if year not in yearly_tables]
+    new_files = [file for file, year in zip(files, years) if year not in yearly_tables]
+    tables = process_years(new_files, new_years, workers=workers) if new_years else None
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    for year in new_years:
+        yearly_tables[year] = tuple(table[table['Year'] == year] for table in tables)
+        for table, path in zip(yearly_tables[year], year_table_paths(year, entries[str(year)]['key'])):
+            save_frame(table, path)
+    # other processes may be loading into the same cache directory, so the manifest is rewritten and the stale
+    # tables removed under a lock, and a table another process already removed is skipped
+    with manifest_lock():
+        if entries != load_manifest():
+            save_manifest(entries)
+        # remove the tables of older versions and of years that are no longer in the datasets directory
+        current_paths = {path for year in years for path in year_table_paths(year, entries[str(year)]['key'])}
+        for path in glob.glob(os.path.join(glob.escape(CACHE_DIR), 'aggregates*.npz')):
+            if path not in current_paths:
+                with suppress(FileNotFoundError):
+                    os.remove(path)
+        for year in set(manifest) - set(entries):
+            for path in glob.glob(os.path.join(glob.escape(CACHE_DIR), f"{os.path.splitext(manifest[year]['file'])[0]}-*.npz")):
+                with suppress(FileNotFoundError):
+                    os.remove(path)
+    if len(new_years) == len(years): # every year was processed together
+        return tables
+    return tuple(combine_frames(tables) for tables in zip(*(yearly_tables[year] for year in years)))
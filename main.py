@@ -1,67 +1,102 @@
-import plotly.express as px
+from functools import lru_cache
+
 import dash
+import flask
 from dash import html
-from dash.dependencies import Input, Output, State
-from data import emission_sums_by_state, top_state_facilities_per_year, power_plant_state_year
+from dash.dependencies import ClientsideFunction, Input, Output, State
+import data
+from config import BACKGROUND_LOADING, CLIENTSIDE_CALLBACKS
 from header import create_header
 from cards import create_cards
-from body import create_body
+from body import create_body, create_loading_body
+from figures import (bar_chart_figure, choropleth_figure, state_map_figure, viewport_bounds, viewport_map_figure,
+                     facility_changes_figure, facility_trend_figure, build_figure_caches)
+from metrics import instrument_callback, register_metrics
+from api import register_api
 
 external_stylesheets = ['/assets/styles.css']
-app = dash.Dash(__name__, external_stylesheets=['/assets/style.css', 'LUX'])
+# while the data loads in the background the page has none of the graphs, so the callbacks cannot be checked against it
+app = dash.Dash(__name__, external_stylesheets=['/assets/style.css', 'LUX'], suppress_callback_exceptions=BACKGROUND_LOADING)
+server = app.server # the WSGI application, served with gunicorn main:server (see gunicorn.conf.py)
+register_metrics(server) # serve the pipeline and callback metrics at /metrics
+register_api(server) # serve the read-only json api at /api
+
+
+
+@lru_cache(maxsize=1)
+def full_layout():
+    return html.Div(id='main', children=[create_header(), create_cards(),
+                                         create_body()])
+
+
+def serve_layout():
+    """
+    Builds the page for every visit when the data is loaded in the background (CO2_BACKGROUND_LOAD=1)
+
+    Until the data is ready, the page has the header, the cards in their loading state and a placeholder
+    that reloads the page once the data is ready; after that it is the full layout, built once
+
+    Returns the layout of the page
+    """
+    if not data.ready.is_set():
+        return html.Div(id='main', children=[create_header(), create_cards(loading=True),
+                                             create_loading_body()])
+    return full_layout()
+
+
+if BACKGROUND_LOADING:
+    app.layout = serve_layout
+else:
+    app.layout = full_layout()
+    data.ready.set() # the layout has loaded the data it shows; everything else is built on first use
+
+
+@server.route('/ready')
+def readiness():
+    """
+    Reports whether the dashboard is ready to serve, for load balancers to hold traffic until it is
+
+    Returns 200 once the data and figure caches are loaded, 503 while they are loading and 500 if loading failed
+    """
+    if data.ready.is_set():
+        return flask.jsonify(status='ready'), 200
+    if data.load_error is not None:
+        return flask.jsonify(status='failed', error=repr(data.load_error)), 500
+    return flask.jsonify(status='loading'), 503
 
-app.layout = html.Div(id='main', children=[create_header(), create_cards(),
-                                           create_body()])
 
 @app.callback(
-    Output('map', 'figure'),
-    [Input('state-selection', 'value'),
-    Input('map-year-slider', 'value')],
-    [State('state-selection', 'value'),
-    State('year-slider', 'value')]
+    Output('loading-location', 'href'),
+    Input('loading-interval', 'n_intervals'),
+    prevent_initial_call=True
 )
+@instrument_callback
+def reload_when_ready(n_intervals):
+    """
+    Reloads the loading page once the data is ready, so it gets the full layout
+
+    Returns the address of the dashboard, or no update while the data is loading
+    """
+    if not data.ready.is_set():
+        return dash.no_update
+    return app.get_relative_path('/')
+
+@instrument_callback
 def update_state_map(selected_dropdown_state, selected_slider_year, current_state, current_year):
     """
     Plots the scatter plot of top 30 facilities per state
 
     Dropdown filters by State Name
-    Hover data includes Facility Name, County, Address, City, State, Zip Code, CO2 emissions, Latitude and Longitude
+    Hover data includes Facility Name, County, Address, City, State, Zip Code, Power Plant Type, CO2 emissions, Latitude and Longitude
 
     Returns the State and the top 40 facilites
     """
     selected_state = current_state if selected_dropdown_state is None else selected_dropdown_state
     selected_year = current_year if selected_slider_year is None else selected_slider_year
-    filtered_df = top_state_facilities_per_year[
-        (top_state_facilities_per_year['State Name'] == selected_state)
-        & (top_state_facilities_per_year['Year'] == selected_year)]
-    top_facilities_map = px.scatter_geo(filtered_df,
-                                        lat='Latitude',
-                                        lon='Longitude',
-                                        hover_name='Facility Name',
-                                        hover_data=['Address', 'City', 'State', 'Zip Code', 'CO2 emissions (non-biogenic)'],
-                                        projection='albers usa',
-                                        size='CO2 emissions (non-biogenic)',
-                                        color='County')
-    top_facilities_map.update_geos(center={'lat': filtered_df['Latitude'].mean(),
-                                   'lon': filtered_df['Longitude'].mean()},
-                                    projection_scale=2.5,
-                                    showcoastlines=True,
-                                    coastlinecolor='black',
-                                    showland=True,
-                                    landcolor='#F8EEDA',
-                                    showrivers=True,
-                                    rivercolor='#AFD1F4',
-                                    bgcolor='#AFD1F4')
-    return top_facilities_map
+    return state_map_figure(selected_state, selected_year)
 
 
-@app.callback(
-    Output('data-graph', 'figure'),
-    [Input('graph-type', 'value'),
-     Input('year-slider', 'value'),
-    Input('top-bottom', 'value')],
-     [State('initial-values', 'data')]
-)
+@instrument_callback
 def update_graph(selected_graph, selected_year, selected_results, initial_values):
     """
     Plots the bar chart of facility counts and non-biogenic co2 emissions
@@ -71,63 +106,125 @@ def update_graph(selected_graph, selected_year, selected_results, initial_values
         Bottom dropdown filters by top 25 and bottom 25 states
 
     Returns the corresponding bar chart representing either the top 25 or bottom 25 states based on facility count or co2 emissions
+    The figures are cached by bar_chart_figure, so repeated selections do not touch pandas
     """
     selected_graph = selected_graph or initial_values['graph_type']
     selected_year = selected_year or initial_values['year']
     selected_results = selected_results or initial_values['results']
-    filtered_df = power_plant_state_year[power_plant_state_year['Year'] == int(selected_year)]
-    if selected_graph == 'Facility Count' and selected_results == 'Top States':
-        sorted_facility_counts = filtered_df.nlargest(25, 'Facility Count').sort_values(by='Facility Count', ascending=False)
-        fig = {
-            'data': [{'x': sorted_facility_counts['State'], 'y': sorted_facility_counts['Facility Count'],
-                     'type': 'bar', 'name': 'Facility Count',
-                      'marker': {'color': '#abaff8', 'line': {'color': '#340447', 'width': 1.5, 'opacity': 0.8}}}],
-            'layout': {'title': f"Total Facilities Per State in {selected_year}",
-                      'xaxis': {'title': ''},
-                       'yaxis': {'title': 'Total Facilities'},
-                      'plot_bgcolor': '#EDEEEE'}
-        }
-    elif selected_graph == 'Facility Count' and selected_results == 'Bottom States':
-        sorted_facility_counts = filtered_df.nsmallest(25, 'Facility Count').sort_values(by='Facility Count', ascending=False)
-        fig = {
-            'data': [{'x': sorted_facility_counts['State'], 'y': sorted_facility_counts['Facility Count'],
-                     'type': 'bar', 'name': 'Facility Count',
-                      'marker': {'color': '#abaff8', 'line': {'color': '#340447', 'width': 1.5, 'opacity': 0.8}}}],
-            'layout': {'title': f"Total Facilities Per State in {selected_year}",
-                      'xaxis': {'title': ''},
-                       'yaxis': {'title': 'Total Facilities'},
-                      'plot_bgcolor': '#EDEEEE'}
-        }
-    elif selected_graph == 'Non-Biogenic CO2 Emissions' and selected_results == 'Top States':
-        sorted_co2_emissions = filtered_df.nlargest(25, 'CO2 emissions (non-biogenic)').sort_values(by='CO2 emissions (non-biogenic)', ascending=False)
-        fig = {
-            'data': [{'x': sorted_co2_emissions['State'], 'y': sorted_co2_emissions['CO2 emissions (non-biogenic)'],
-                     'type': 'bar', 'name': 'Non-Biogenic CO2 Emissions',
-                      'marker': {'color': '#98D0EB', 'line': {'color': '#1C5699', 'width': 1.5, 'opacity': 0.8}}}],
-            'layout': {'title': f"Total Non-Biogenic CO2 Emissions Per State in {selected_year}",
-                      'xaxis': {'title': ''},
-                       'yaxis': {'title': 'Non-Biogenic CO2 Emissions (MMmt)'},
-                        'plot_bgcolor': '#EDEEEE'}
-        }
-    elif selected_graph == 'Non-Biogenic CO2 Emissions' and selected_results == 'Bottom States':
-        sorted_co2_emissions = filtered_df.nsmallest(25, 'CO2 emissions (non-biogenic)').sort_values(by='CO2 emissions (non-biogenic)', ascending=False)
-        fig = {
-            'data': [{'x': sorted_co2_emissions['State'], 'y': sorted_co2_emissions['CO2 emissions (non-biogenic)'],
-                     'type': 'bar', 'name': 'Non-Biogenic CO2 Emissions',
-                      'marker': {'color': '#98D0EB', 'line': {'color': '#1C5699', 'width': 1.5, 'opacity': 0.8}}}],
-            'layout': {'title': f"Total Non-Biogenic CO2 Emissions Per State in {selected_year}",
-                      'xaxis': {'title': ''},
-                       'yaxis': {'title': 'Non-Biogenic CO2 Emissions (MMmt)'},
-                        'plot_bgcolor': '#EDEEEE'}
-        }
-    else:
-        fig = {}
-    return fig
+    return bar_chart_figure(selected_graph, int(selected_year), selected_results)
+
+
+state_map_inputs = [Input('state-selection', 'value'),
+                    Input('map-year-slider', 'value')]
+state_map_states = [State('state-selection', 'value'),
+                    State('year-slider', 'value')]
+graph_inputs = [Input('graph-type', 'value'),
+                Input('year-slider', 'value'),
+                Input('top-bottom', 'value')]
+graph_states = [State('initial-values', 'data')]
+
+if CLIENTSIDE_CALLBACKS:
+    # switch years in the browser (assets/clientside.js) using the per-year arrays in the year-data store
+    app.clientside_callback(ClientsideFunction(namespace='clientside', function_name='update_state_map'),
+                            Output('map', 'figure'), state_map_inputs, state_map_states + [State('year-data', 'data')])
+    app.clientside_callback(ClientsideFunction(namespace='clientside', function_name='update_graph'),
+                            Output('data-graph', 'figure'), graph_inputs, graph_states + [State('year-data', 'data')])
+else:
+    app.callback(Output('map', 'figure'), state_map_inputs, state_map_states)(update_state_map)
+    app.callback(Output('data-graph', 'figure'), graph_inputs, graph_states)(update_graph)
+
+
+@app.callback(
+    Output('map', 'style'),
+    Output('viewport-map', 'style'),
+    Input('map-mode', 'value'),
+    State('map', 'style'),
+    State('viewport-map', 'style')
+)
+@instrument_callback
+def update_map_mode(map_mode, map_style, viewport_map_style):
+    """
+    Shows the facility map of the selected mode and hides the other one
+
+    Returns the styles of the largest facilities map and the power plants in view map
+    """
+    viewport_mode = map_mode == 'viewport'
+    return ({**map_style, 'display': 'none' if viewport_mode else 'inline-block'},
+            {**viewport_map_style, 'display': 'block' if viewport_mode else 'none'})
+
+
+@app.callback(
+    Output('viewport-map', 'figure'),
+    Output('viewport-bounds', 'data'),
+    Input('map-mode', 'value'),
+    Input('viewport-map', 'relayoutData'),
+    Input('state-selection', 'value'),
+    Input('map-year-slider', 'value'),
+    State('viewport-bounds', 'data')
+)
+@instrument_callback
+def update_viewport_map(map_mode, relayout_data, selected_state, selected_year, current_bounds):
+    """
+    Plots the power plants inside the current view of the map, in the 'power plants in view' mode
+
+    Panning or zooming the map queries the spatial index for the power plants in the new view
+    Selecting a state moves the view to that state; changing the year keeps the current view
+
+    Returns the figure and the bounds of the view (None for the initial view of the state)
+    """
+    if map_mode != 'viewport':
+        return dash.no_update, dash.no_update
+    bounds = None
+    if dash.ctx.triggered_id == 'viewport-map':
+        bounds = viewport_bounds(relayout_data) or current_bounds
+    elif dash.ctx.triggered_id != 'state-selection':
+        bounds = current_bounds
+    return viewport_map_figure(selected_state, selected_year, bounds), bounds
+
+
+@app.callback(
+    Output('facility-changes', 'figure'),
+    Input('change-direction', 'value'),
+    Input('change-years', 'value'),
+    Input('change-state', 'value')
+)
+@instrument_callback
+def update_facility_changes(selected_direction, selected_years, selected_state):
+    """
+    Plots the bar chart of the power plants whose emissions fell or rose the most between two years
+
+    Contains a choice of decreases or increases, a state dropdown (all states when empty) and a range slider of the two years
+
+    Returns the bar chart of the largest changes, from the facility matrix (see trends.py)
+    """
+    start_year, end_year = selected_years
+    return facility_changes_figure(selected_direction, start_year, end_year, selected_state)
+
+
+@app.callback(
+    Output('facility-trend', 'figure'),
+    Input('facility-changes', 'clickData'),
+    Input('facility-changes', 'figure')
+)
+@instrument_callback
+def update_facility_trend(click_data, changes_figure):
+    """
+    Plots the emissions of a facility in every year it reported
+
+    Clicking a bar of the largest changes chart selects its facility; a new ranking selects its largest change
+
+    Returns the line chart of the selected facility
+    """
+    if click_data and 'facility-changes.clickData' in dash.ctx.triggered_prop_ids:
+        return facility_trend_figure(click_data['points'][0]['customdata'])
+    facility_ids = changes_figure['data'][0]['customdata'] if changes_figure and changes_figure.get('data') else []
+    return facility_trend_figure(facility_ids[-1] if facility_ids else None) # the largest change is the last bar
 
 @app.callback(
     Output('choropleth-map', 'figure'),
     Input('play-button', 'play_button')
 )
+@instrument_callback
 def update_choropleth_map(play_button):
     """
     Plots the interactive choropleth map on the dashboard
@@ -135,26 +232,12 @@ def update_choropleth_map(play_button):
     Represents the total emissions for each state by year
 
     Consists of a play and stop button
+    The figure is built once per dataset version by choropleth_figure and served from its cache
     """
-    choropleth_map = px.choropleth(emission_sums_by_state,
-                        locations='State',
-                        locationmode='USA-states',
-                        color='CO2 emissions (non-biogenic)',
-                        color_continuous_scale='dense',
-                        animation_frame='Year',
-                        range_color=[emission_sums_by_state['CO2 emissions (non-biogenic)'].min(),
-                                        emission_sums_by_state['CO2 emissions (non-biogenic)'].max()],
-                        scope='usa')
-    choropleth_map.update_layout(
-        coloraxis_colorbar=dict(
-            title= 'CO2 emissions (MMmt)',
-            title_font=dict(size=10),
-            len=1,
-            thickness=10
-            )
-        )
-    return choropleth_map
+    return choropleth_figure()
 
 if __name__ == '__main__':
+    if BACKGROUND_LOADING:
+        data.start_background_load(warm_up=build_figure_caches) # serve the loading page while the data loads
     app.run_server(port=1599)
 
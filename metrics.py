@@ -0,0 +1,354 @@
+import bisect
+import functools
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import flask
+
+from config import METRICS_ENABLED
+
+# the upper bounds of the histogram buckets for durations (seconds) and payload sizes (bytes)
+DURATION_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+SIZE_BUCKETS = [1000, 10000, 100000, 250000, 1000000, 2500000, 10000000]
+
+# the description of each metric, shown in the /metrics output
+DESCRIPTIONS = {
+    'co2_pipeline_stage_seconds': 'Time spent in each stage of the data pipeline',
+    'co2_pipeline_rows_total': 'Rows returned by each stage of the data pipeline',
+    'co2_callback_seconds': 'Time spent in each dash callback',
+    'co2_callback_errors_total': 'Dash callbacks that raised an exception',
+    'co2_callback_payload_bytes': 'Size of the response sent for each dash callback output',
+    'co2_figure_cache_hits_total': 'Figure cache hits',
+    'co2_figure_cache_misses_total': 'Figure cache misses',
+    'co2_api_cache_hits_total': 'API response cache hits',
+    'co2_api_cache_misses_total': 'API response cache misses',
+}
+
+lock = threading.Lock()
+histograms = {} # (name, labels) -> [bucket bounds, bucket counts, sum, count]
+counters = {} # (name, labels) -> value
+# the directory where every process serving the dashboard saves its metrics (see share_between_processes),
+# None when the dashboard is served by one process
+shared_directory = None
+# the figure and api cache counts a worker process inherited from the master process, which the master reports itself
+cache_offsets = {}
+# the number of changes to the metrics of this process, and the number (with the cache counts of cache_stats)
+# when they were last saved to the shared directory
+changes = 0
+saved_changes = None
+
+
+def reset_lock():
+    """
+    Give a forked process a new lock
+
+    The ingest pool can be forked from the background loading thread while a request thread holds the lock,
+    and the child would then wait forever for a lock no thread of it will release
+    """
+    global lock
+    lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'): # not on Windows, which has no fork
+    os.register_at_fork(after_in_child=reset_lock)
+
+
+def observe(name, value, buckets=DURATION_BUCKETS, **labels):
+    """
+    Record a value in a histogram
+    """
+    if not METRICS_ENABLED:
+        return
+    global changes
+    key = (name, tuple(sorted(labels.items())))
+    with lock:
+        changes += 1
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = [buckets, [0] * len(buckets), 0.0, 0]
+        position = bisect.bisect_left(buckets, value)
+        if position < len(buckets):
+            histogram[1][position] += 1
+        histogram[2] += value
+        histogram[3] += 1
+
+
+def increment(name, amount=1, **labels):
+    """
+    Add an amount to a counter
+    """
+    if not METRICS_ENABLED:
+        return
+    global changes
+    key = (name, tuple(sorted(labels.items())))
+    with lock:
+        changes += 1
+        counters[key] = counters.get(key, 0) + amount
+
+
+@contextmanager
+def timed_stage(stage):
+    """
+    Time a block of pipeline code as the named stage
+
+    Yields a dictionary; setting its 'rows' key records the number of rows the stage produced
+    """
+    counts = {}
+    start = time.perf_counter()
+    yield counts
+    observe('co2_pipeline_stage_seconds', time.perf_counter() - start, stage=stage)
+    if 'rows' in counts:
+        increment('co2_pipeline_rows_total', counts['rows'], stage=stage)
+
+
+def instrument_stage(stage):
+    """
+    Decorator that times a pipeline function as the named stage and counts the rows of the dataframe it returns
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with timed_stage(stage) as counts:
+                result = function(*args, **kwargs)
+                counts['rows'] = len(result)
+            return result
+        return wrapper
+    return decorator
+
+
+def instrument_callback(function):
+    """
+    Decorator that records the latency, call count and errors of a dash callback
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        except Exception:
+            increment('co2_callback_errors_total', callback=function.__name__)
+            raise
+        finally:
+            observe('co2_callback_seconds', time.perf_counter() - start, callback=function.__name__)
+    return wrapper
+
+
+def snapshot():
+    """
+    Copy the recorded metrics, so they can be sent from a worker process to the main process
+
+    Returns:
+    A tuple of the histograms and counters
+    """
+    with lock:
+        return ({key: [value[0], list(value[1]), value[2], value[3]] for key, value in histograms.items()},
+                dict(counters))
+
+
+def combine(target_histograms, target_counters, recorded):
+    """
+    Add metrics recorded in another process (see snapshot) to dictionaries of histograms and counters
+    """
+    recorded_histograms, recorded_counters = recorded
+    for key, (buckets, bucket_counts, total, count) in recorded_histograms.items():
+        histogram = target_histograms.setdefault(key, [buckets, [0] * len(buckets), 0.0, 0])
+        histogram[1] = [current + new for current, new in zip(histogram[1], bucket_counts)]
+        histogram[2] += total
+        histogram[3] += count
+    for key, value in recorded_counters.items():
+        target_counters[key] = target_counters.get(key, 0) + value
+
+
+def merge(recorded):
+    """
+    Add metrics recorded in another process (see snapshot) to the metrics of this process
+    """
+    global changes
+    with lock:
+        changes += 1
+        combine(histograms, counters, recorded)
+
+
+def reset():
+    """
+    Remove all recorded metrics
+    """
+    global changes
+    with lock:
+        changes += 1
+        histograms.clear()
+        counters.clear()
+
+
+def format_labels(labels, **extra):
+    labels = list(labels) + list(extra.items())
+    if not labels:
+        return ''
+    escaped = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in labels]
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def cache_stats():
+    """
+    Find the hit and miss counts of the figure caches (figures.figure_cache_stats)
+    and the api response caches (api.api_cache_stats)
+
+    Returns:
+    A dictionary from the metric name prefix and the cache name to the hits and misses of the cache
+    """
+    from api import api_cache_stats
+    from figures import figure_cache_stats
+    return {**{('co2_figure_cache', name): stats for name, stats in figure_cache_stats().items()},
+            **{('co2_api_cache', name): stats for name, stats in api_cache_stats().items()}}
+
+
+def process_snapshot():
+    """
+    Copy the metrics of this process, along with the figure and api cache hits and misses from cache_stats
+    (less the counts inherited from the master process, see start_worker)
+
+    Returns:
+    A tuple of the histograms and counters, like snapshot
+    """
+    histogram_copy, counter_copy = snapshot()
+    for (prefix, cache_name), stats in cache_stats().items():
+        offsets = cache_offsets.get((prefix, cache_name), {})
+        counter_copy[(f'{prefix}_hits_total', (('cache', cache_name),))] = stats['hits'] - offsets.get('hits', 0)
+        counter_copy[(f'{prefix}_misses_total', (('cache', cache_name),))] = stats['misses'] - offsets.get('misses', 0)
+    return histogram_copy, counter_copy
+
+
+def share_between_processes(directory):
+    """
+    Report the metrics of every process serving the dashboard (the gunicorn master and workers) from any of them
+
+    Called in the master process before the workers are forked; every process then saves its metrics
+    to a file of its own in the directory (see save_shared), and /metrics adds up the files of the other processes
+    and the metrics of the process that answers. The files of workers that have exited are kept,
+    so the counters never go down when a worker is replaced
+    """
+    global shared_directory
+    os.makedirs(directory, exist_ok=True)
+    shared_directory = directory
+
+
+def start_worker():
+    """
+    Clear the metrics a worker process inherited from the master process when it was forked
+
+    The master process reports them in its own file (see save_shared), so they would otherwise be counted twice;
+    the figure and api caches cannot be cleared, so the counts they start with are subtracted instead
+    """
+    reset()
+    cache_offsets.update(cache_stats())
+
+
+def save_shared():
+    """
+    Save the metrics of this process to its file in the shared directory, if there is one
+
+    The file is only written when the metrics or the cache counts changed since it was last saved,
+    so requests that record nothing (such as the api responses answered with 304) do not write it
+    Like cache.save_frame, the file is written under a temporary name first and then renamed
+    """
+    global saved_changes
+    if shared_directory is None or not METRICS_ENABLED:
+        return
+    # the cache counts are read from the caches themselves, so they do not add to changes
+    current = (changes, [(stats['hits'], stats['misses']) for stats in cache_stats().values()])
+    if current == saved_changes:
+        return
+    saved_changes = current
+    histogram_copy, counter_copy = process_snapshot()
+    # json has no tuples, so every metric is saved as a list with its labels as a list of pairs
+    recorded = {'histograms': [[name, labels, *histogram] for (name, labels), histogram in histogram_copy.items()],
+                'counters': [[name, labels, value] for (name, labels), value in counter_copy.items()]}
+    path = os.path.join(shared_directory, f'{os.getpid()}.json')
+    temporary_path = f'{path}.tmp'
+    with open(temporary_path, 'w') as shared_file:
+        json.dump(recorded, shared_file)
+    os.replace(temporary_path, path)
+
+
+def load_shared():
+    """
+    Load the metrics saved by the other processes in the shared directory
+
+    Returns:
+    A list with a tuple of the histograms and counters (like snapshot) of every other process
+    """
+    loaded = []
+    own_path = os.path.join(shared_directory, f'{os.getpid()}.json')
+    for path in glob.glob(os.path.join(glob.escape(shared_directory), '*.json')):
+        if path == own_path:
+            continue
+        try:
+            with open(path) as shared_file:
+                recorded = json.load(shared_file)
+        except (OSError, ValueError):
+            continue
+        loaded.append(({(name, tuple(map(tuple, labels))): [buckets, bucket_counts, total, count]
+                        for name, labels, buckets, bucket_counts, total, count in recorded['histograms']},
+                       {(name, tuple(map(tuple, labels))): value for name, labels, value in recorded['counters']}))
+    return loaded
+
+
+def render():
+    """
+    Write the recorded metrics in the Prometheus text format
+
+    The figure and api cache hits and misses are read from cache_stats when the metrics are rendered
+    When the metrics are shared between processes (see share_between_processes), the metrics of every process are added up
+
+    Returns:
+    The metrics as a string
+    """
+    histogram_copy, counter_copy = process_snapshot()
+    if shared_directory is not None:
+        for recorded in load_shared():
+            combine(histogram_copy, counter_copy, recorded)
+    lines = []
+    for name in sorted({key[0] for key in histogram_copy}):
+        lines.append(f'# HELP {name} {DESCRIPTIONS.get(name, name)}')
+        lines.append(f'# TYPE {name} histogram')
+        for (metric, labels), (buckets, bucket_counts, total, count) in sorted(histogram_copy.items()):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, bucket_count in zip(buckets, bucket_counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{format_labels(labels, le=bound)} {cumulative}')
+            lines.append(f'{name}_bucket{format_labels(labels, le="+Inf")} {count}')
+            lines.append(f'{name}_sum{format_labels(labels)} {total}')
+            lines.append(f'{name}_count{format_labels(labels)} {count}')
+    for name in sorted({key[0] for key in counter_copy}):
+        lines.append(f'# HELP {name} {DESCRIPTIONS.get(name, name)}')
+        lines.append(f'# TYPE {name} counter')
+        for (metric, labels), value in sorted(counter_copy.items()):
+            if metric == name:
+                lines.append(f'{name}{format_labels(labels)} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def register_metrics(server):
+    """
+    Add the /metrics endpoint to the flask server behind the dash app
+    and record the size of every callback response
+
+    When the metrics are shared between processes, this process saves its metrics after every request
+    """
+    @server.route('/metrics')
+    def metrics_endpoint():
+        return flask.Response(render(), mimetype='text/plain; version=0.0.4')
+
+    @server.after_request
+    def record_payload_size(response):
+        if METRICS_ENABLED and flask.request.path.endswith('/_dash-update-component') and response.content_length is not None:
+            body = flask.request.get_json(silent=True) or {}
+            observe('co2_callback_payload_bytes', response.content_length, buckets=SIZE_BUCKETS, output=body.get('output', ''))
+        save_shared() # let the other processes report the metrics of this request
+        return response
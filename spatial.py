@@ -0,0 +1,276 @@
+import math
+
+import numpy as np
+
+# the mean radius of the earth, used for the distances between facilities
+EARTH_RADIUS_KM = 6371.0088
+DISTANCE = 'Distance (km)'
+
+
+def grid_shape(cell_degrees):
+    """
+    Find the number of rows (latitude) and columns (longitude) of a grid of cells cell_degrees wide over the globe
+
+    Returns:
+    A tuple of the number of rows and columns
+    """
+    return math.ceil(180 / cell_degrees), math.ceil(360 / cell_degrees)
+
+
+def grid_rows(latitude, cell_degrees, rows):
+    return np.clip(np.floor((np.asarray(latitude) + 90) / cell_degrees).astype(np.int64), 0, rows - 1)
+
+
+def grid_columns(longitude, cell_degrees, columns):
+    return np.clip(np.floor((np.asarray(longitude) + 180) / cell_degrees).astype(np.int64), 0, columns - 1)
+
+
+def build_spatial_index(data, cell_degrees=0.5):
+    """
+    Build a grid index over the latitude and longitude of the facilities of every year
+
+    Function takes a dataframe with Latitude, Longitude, Year and Power Plant columns (see functions.facility_locations)
+    Every facility is given the number of its grid cell, counting the cells of each year after those of the years before
+        cell = (year position * rows + latitude row) * columns + longitude column
+    and the facilities are sorted by cell, so the facilities of one row of cells within one year are a contiguous
+    slice of the sorted rows that is found with a binary search (np.searchsorted)
+    A query then only looks at the cells that overlap its area instead of every facility
+
+    Only the cells, coordinates and row order are copied; the facilities themselves stay in the dataframe that is passed in
+
+    Returns:
+    A dictionary with:
+        data: the dataframe of facilities, as passed in
+        order: the positions of the rows of data, sorted by cell
+        latitude, longitude, power_plant: the columns used by the queries, as numpy arrays sorted by cell
+        cells: the sorted cell of every facility
+        years: the sorted years in the index
+        cell_degrees, rows, columns: the size and shape of the grid
+    """
+    rows, columns = grid_shape(cell_degrees)
+    years = np.unique(data['Year'].to_numpy())
+    latitude = data['Latitude'].to_numpy(dtype=float)
+    longitude = data['Longitude'].to_numpy(dtype=float)
+    year_positions = np.searchsorted(years, data['Year'].to_numpy()).astype(np.int64)
+    cells = ((year_positions * rows + grid_rows(latitude, cell_degrees, rows)) * columns
+             + grid_columns(longitude, cell_degrees, columns))
+    order = np.argsort(cells, kind='stable') # a stable sort keeps the facilities of a cell in their original order
+    return {'data': data, 'order': order,
+            'latitude': latitude[order], 'longitude': longitude[order],
+            'power_plant': data['Power Plant'].to_numpy(dtype=bool)[order],
+            'cells': cells[order], 'years': years,
+            'cell_degrees': cell_degrees, 'rows': rows, 'columns': columns}
+
+
+def selected_year_positions(index, year=None):
+    """
+    Find the positions of a year in the years of the index
+
+    Returns:
+    An array with the position of the year (empty if the year is not in the index), or of every year if year is None
+    """
+    if year is None:
+        return np.arange(len(index['years']))
+    position = np.searchsorted(index['years'], year)
+    if position < len(index['years']) and index['years'][position] == year:
+        return np.array([position])
+    return np.array([], dtype=np.int64)
+
+
+def positions_in_box(index, south, west, north, east, year=None, power_plants_only=False):
+    """
+    Find the facilities inside a latitude and longitude box
+
+    A box with west greater than east crosses the 180th meridian and is split in two
+
+    Returns:
+    An array of the positions of the facilities in the sorted arrays of the index, ordered by cell
+    """
+    if west > east:
+        return np.concatenate([positions_in_box(index, south, west, north, 180, year, power_plants_only),
+                               positions_in_box(index, south, -180, north, east, year, power_plants_only)])
+    cell_degrees, rows, columns = index['cell_degrees'], index['rows'], index['columns']
+    row_range = np.arange(grid_rows(south, cell_degrees, rows), grid_rows(north, cell_degrees, rows) + 1)
+    first_column = grid_columns(west, cell_degrees, columns)
+    last_column = grid_columns(east, cell_degrees, columns)
+    # the first cell of every overlapping row of every selected year; the cells up to last_column follow it
+    row_starts = ((selected_year_positions(index, year)[:, None] * rows + row_range[None, :]) * columns).ravel()
+    starts = np.searchsorted(index['cells'], row_starts + first_column, side='left')
+    stops = np.searchsorted(index['cells'], row_starts + last_column, side='right')
+    lengths = stops - starts
+    # expand every (start, stop) slice into its positions without a python loop
+    positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+    # the cells on the edge of the box stick out of it, so check the exact coordinates
+    latitude, longitude = index['latitude'][positions], index['longitude'][positions]
+    inside = (latitude >= south) & (latitude <= north) & (longitude >= west) & (longitude <= east)
+    if power_plants_only:
+        inside &= index['power_plant'][positions]
+    return positions[inside]
+
+
+def haversine_km(latitude, longitude, latitudes, longitudes):
+    """
+    Find the great circle distances from one point to an array of points
+
+    Returns:
+    An array of distances in kilometers
+    """
+    latitude, longitude = np.radians(latitude), np.radians(longitude)
+    latitudes, longitudes = np.radians(latitudes), np.radians(longitudes)
+    a = (np.sin((latitudes - latitude) / 2) ** 2
+         + np.cos(latitude) * np.cos(latitudes) * np.sin((longitudes - longitude) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def positions_in_radius(index, latitude, longitude, radius_km, year=None, power_plants_only=False):
+    """
+    Find the facilities within radius_km kilometers of a point
+
+    The facilities in the box around the circle are found with positions_in_box
+    and then checked with their exact great circle distance
+
+    Returns:
+    A tuple of the positions of the facilities in the sorted arrays of the index and their distances, nearest first
+    """
+    angle = radius_km / EARTH_RADIUS_KM
+    south, north = latitude - math.degrees(angle), latitude + math.degrees(angle)
+    if north >= 90 or south <= -90 or angle >= math.pi / 2: # the circle covers a pole, so it spans every longitude
+        west, east = -180, 180
+    else:
+        # the widest longitude of the circle, which is not at the latitude of its center
+        spread = math.degrees(math.asin(min(1, math.sin(angle) / math.cos(math.radians(latitude)))))
+        west, east = longitude - spread, longitude + spread
+        if east - west >= 360:
+            west, east = -180, 180
+        else:
+            west = west + 360 if west < -180 else west
+            east = east - 360 if east > 180 else east
+    positions = positions_in_box(index, max(south, -90), west, min(north, 90), east, year, power_plants_only)
+    distances = haversine_km(latitude, longitude, index['latitude'][positions], index['longitude'][positions])
+    within = distances <= radius_km
+    positions, distances = positions[within], distances[within]
+    order = np.argsort(distances, kind='stable')
+    return positions[order], distances[order]
+
+
+def facilities_at(index, positions):
+    """
+    Find the facilities at positions of the sorted arrays of an index
+
+    Returns:
+    A dataframe with the rows of index['data'] for the positions, in the same order
+    """
+    return index['data'].iloc[index['order'][positions]]
+
+
+def query_bbox(index, south, west, north, east, year=None, power_plants_only=False):
+    """
+    Find the facilities inside a box of latitudes (south to north) and longitudes (west to east)
+
+    Input is an index from build_spatial_index, the edges of the box in degrees,
+    the year (None for every year) and whether to only return power plants
+
+    Returns:
+    A dataframe of the facilities in the box
+    """
+    return facilities_at(index, positions_in_box(index, south, west, north, east, year, power_plants_only))
+
+
+def query_radius(index, latitude, longitude, radius_km, year=None, power_plants_only=False):
+    """
+    Find the facilities within radius_km kilometers of a point
+
+    Input is an index from build_spatial_index, the latitude and longitude of the point, the radius,
+    the year (None for every year) and whether to only return power plants
+
+    Returns:
+    A dataframe of the facilities in the circle, nearest first, with their distance in a Distance (km) column
+    """
+    positions, distances = positions_in_radius(index, latitude, longitude, radius_km, year, power_plants_only)
+    return facilities_at(index, positions).assign(**{DISTANCE: distances})
+
+
+def query_nearest(index, latitude, longitude, k=10, year=None, power_plants_only=False):
+    """
+    Find the k facilities nearest to a point
+
+    Function searches a circle around the point and widens it four times over until it holds at least k facilities,
+    so only the cells near the point are read; every facility inside the circle is closer than any facility outside it
+
+    Returns:
+    A dataframe of the k nearest facilities (fewer if the index has fewer), nearest first,
+    with their distance in a Distance (km) column
+    """
+    radius_km = index['cell_degrees'] * 111 # about one grid cell
+    while True:
+        positions, distances = positions_in_radius(index, latitude, longitude, radius_km, year, power_plants_only)
+        if len(positions) >= k or radius_km >= math.pi * EARTH_RADIUS_KM: # found enough, or searched the whole globe
+            break
+        radius_km *= 4
+    return facilities_at(index, positions[:k]).assign(**{DISTANCE: distances[:k]})
+
+
+# the width in pixels of the grid cells that facilities are clustered into at every zoom level (see cluster_cell_degrees)
+CLUSTER_CELL_PIXELS = 40
+
+
+def cluster_cell_degrees(zoom):
+    """
+    Find the size of the cells that facilities are clustered into at a zoom level of the map
+
+    At zoom level z a web map is 512 * 2 ** z pixels around, so a cell CLUSTER_CELL_PIXELS wide on screen
+    covers the same number of degrees at every point of the map, and halves with every zoom level
+
+    Returns:
+    The width of the cells in degrees
+    """
+    return 360 * CLUSTER_CELL_PIXELS / (512 * 2 ** zoom)
+
+
+def cluster_facilities(data, cell_degrees):
+    """
+    Cluster the facilities of every year into the cells of a latitude and longitude grid
+
+    Function takes a dataframe from functions.facility_locations and finds, for every year and grid cell,
+    in one groupby:
+        Latitude and Longitude: the mean position of the facilities of the cell, where the cluster is drawn
+        Facility Count: the number of facilities
+        CO2 emissions (non-biogenic): the sum of their emissions
+        Largest Facility: the name of the facility with the largest emissions
+
+    Returns:
+    A dataframe with one row per year and cell that has facilities, with Year and Power Plant columns
+    so it can be indexed with build_spatial_index
+    """
+    rows, columns = grid_shape(cell_degrees)
+    ranked = data.sort_values('CO2 emissions (non-biogenic)', ascending=False, kind='mergesort')
+    cells = (grid_rows(ranked['Latitude'].to_numpy(), cell_degrees, rows) * columns
+             + grid_columns(ranked['Longitude'].to_numpy(), cell_degrees, columns))
+    ranked = ranked.assign(Cell=cells)
+    clusters = ranked.groupby(['Year', 'Cell']).agg(
+        **{'Latitude': ('Latitude', 'mean'), 'Longitude': ('Longitude', 'mean'),
+           'Facility Count': ('Latitude', 'size'),
+           'CO2 emissions (non-biogenic)': ('CO2 emissions (non-biogenic)', 'sum')})
+    # the facilities are ranked, so the first one of each cell is the largest
+    # (groupby first on a categorical column falls back to a slow python loop)
+    largest = ranked.drop_duplicates(['Year', 'Cell']).set_index(['Year', 'Cell'])['Facility Name']
+    clusters['Largest Facility'] = largest.reindex(clusters.index).astype(object).to_numpy()
+    clusters = clusters.reset_index(level='Year').reset_index(drop=True)
+    clusters['Power Plant'] = data['Power Plant'].all()
+    return clusters
+
+
+def build_cluster_levels(data, levels):
+    """
+    Precompute the clusters of the facilities at the zoom levels 0 to levels - 1 of the map
+
+    Each level is clustered with cluster_facilities, with cells of cluster_cell_degrees of the zoom level,
+    and indexed with build_spatial_index using the same cells, so the clusters in a view are found with query_bbox
+    A view of any size holds about as many clusters as cells of CLUSTER_CELL_PIXELS fit on the screen,
+    however many facilities are clustered
+
+    Returns:
+    A list with the spatial index of the clusters of every zoom level
+    """
+    return [build_spatial_index(cluster_facilities(data, cluster_cell_degrees(zoom)), cell_degrees=cluster_cell_degrees(zoom))
+            for zoom in range(levels)]
@@ -0,0 +1,92 @@
+import pandas as pd
+
+from cube import CELL_COLUMNS, cube_cells, combine_cells
+from functions import EMISSIONS, read_chunks, clean_data, classify_facilities, top_k_per_group, facility_locations
+
+# the column that holds the row number of each facility within its csv file while streaming
+ROW = 'Row'
+# the groups whose mean fills in the missing emissions (see fill_na_values)
+FILL_GROUPS = ['State', 'Industry Type (sectors)']
+
+
+def add_totals(totals, new_totals):
+    """
+    Add two series or dataframes of running totals, matching them on their index
+
+    Returns:
+    The sum, with the index of both inputs
+    """
+    if totals is None:
+        return new_totals
+    return totals.add(new_totals, fill_value=0)
+
+
+def keep_top_rows(data, n):
+    """
+    Keep the n facilities with the largest emissions of every state
+
+    The rows are put back in file order first, so that ties are broken the same way as when the whole file is ranked
+
+    Returns:
+    A dataframe with at most n rows per state
+    """
+    data = data.sort_values(ROW, kind='mergesort')
+    return top_k_per_group(data, EMISSIONS, k=n, by='State Name')
+
+
+def stream_year(file, year, chunk_rows, n=30):
+    """
+    Run the pipeline for one year of data without loading the whole csv file
+
+    The file is read chunk_rows rows at a time and every chunk is cleaned and classified on its own
+    Each chunk is then folded into running aggregates, so the memory used does not grow with the size of the file:
+        the sum and count of the emissions of every state and industry sector, for the mean used by fill_na_values
+        the n largest power plants of every state
+        the first n power plants with missing emissions of every state and sector
+        (once filled they all get the mean of their group, so later ones can never reach the top n)
+        the cells of the aggregation cube (cube.cube_cells) of the facilities with known emissions,
+        and the number of facilities with missing emissions in every cell
+    After the last chunk, the missing emissions are filled with the mean of their group and folded in as well;
+    the facilities of a cell share its state and sector, so its missing emissions all get the same mean
+    The location of every facility (functions.facility_locations) grows with the file, so it is not kept:
+    the table of locations is empty, and the spatial index and facility trends have no facilities
+
+    Returns:
+    The same three dataframes as ingest.process_years gives for one year:
+    the n largest power plant facilities per state, the (empty) location of every facility and the cube cells
+    """
+    group_totals = None # sum and count of the known emissions of every state and sector
+    missing_counts = None # number of facilities with missing emissions in every cube cell
+    top_rows = missing_rows = cells = locations = None
+    for chunk in read_chunks(file, chunk_rows):
+        data = classify_facilities(clean_data(chunk))
+        data['Year'] = year
+        data[ROW] = data.index
+        if locations is None:
+            locations = facility_locations(data.iloc[:0])
+        group_totals = add_totals(group_totals, data.groupby(FILL_GROUPS)[EMISSIONS].agg(['sum', 'count']))
+        known = data[EMISSIONS].notna()
+        cells = combine_cells(pd.concat([cells, cube_cells(data[known])]))
+        missing_counts = add_totals(missing_counts, data[~known].groupby(CELL_COLUMNS).size())
+        power_plants = data[data['Power Plant']]
+        top_rows = keep_top_rows(pd.concat([top_rows, power_plants[power_plants[EMISSIONS].notna()]]), n)
+        missing = power_plants[power_plants[EMISSIONS].isna()]
+        missing_rows = pd.concat([missing_rows, missing]).groupby(FILL_GROUPS, sort=False).head(n)
+
+    # fill in the missing emissions with the mean of their state and sector, dropping those without a mean
+    means = group_totals['sum'] / group_totals['count'].where(group_totals['count'] > 0)
+    if missing_rows is not None and len(missing_rows):
+        filled = missing_rows.join(means.rename('Mean'), on=FILL_GROUPS)
+        filled[EMISSIONS] = filled.pop('Mean')
+        top_rows = keep_top_rows(pd.concat([top_rows, filled.dropna(subset=[EMISSIONS])]), n)
+    if missing_counts is not None and len(missing_counts):
+        filled = missing_counts.astype('int64').rename('Facility Count').reset_index().join(means.rename('Mean'), on=FILL_GROUPS)
+        filled = filled.dropna(subset=['Mean'])
+        mean = filled.pop('Mean')
+        filled = filled.assign(**{EMISSIONS: filled['Facility Count'] * mean,
+                                  'Smallest CO2 emissions (non-biogenic)': mean,
+                                  'Largest CO2 emissions (non-biogenic)': mean})
+        cells = combine_cells(pd.concat([cells, filled]))
+
+    state_facilities = top_k_per_group(top_rows.sort_values(ROW, kind='mergesort'), EMISSIONS, k=n, by='State Name')
+    return state_facilities.drop(columns=ROW), locations, cells
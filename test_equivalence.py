@@ -0,0 +1,125 @@
+"""
+Checks that the fast paths of the pipeline give the same answers as the plain ones
+
+    the streamed tables of a year match the tables of the whole csv file (streaming.stream_year)
+    the incremental load of a changed year matches a full recompute (ingest.load_years)
+    the spatial index queries match a brute force search over every facility (spatial.py)
+
+Run with python -m pytest from the repository directory; only the first two datasets are read, to keep it quick
+"""
+import shutil
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import cache
+import ingest
+import spatial
+from config import DATASETS_DIR, TOP_FACILITIES
+from cube import build_cube
+from functions import import_and_clean, stack_years, aggregate_years, combine_frames, compact_frame
+from streaming import stream_year
+
+DATASETS = dict(list(ingest.discover_datasets(DATASETS_DIR).items())[:2])
+# small enough that every file is streamed in many chunks
+CHUNK_ROWS = 3000
+# the sums are added up in a different order when streaming
+RTOL = 1e-9
+
+
+def assert_tables_equal(expected, actual):
+    pd.testing.assert_frame_equal(expected.reset_index(drop=True), actual.reset_index(drop=True),
+                                  check_dtype=False, check_categorical=False, check_exact=False, rtol=RTOL)
+
+
+def assert_cubes_equal(expected, actual):
+    assert expected['rollups'].keys() == actual['rollups'].keys()
+    for dimensions, rollup in expected['rollups'].items():
+        assert_tables_equal(rollup.astype(object), actual['rollups'][dimensions].astype(object))
+    pd.testing.assert_series_equal(expected['state_names'].sort_index(), actual['state_names'].sort_index())
+
+
+@pytest.fixture(scope='module')
+def whole_file_tables():
+    # the tables of the normal mode, straight from the csv files (the cache is not used)
+    frames = [import_and_clean(file) for file in DATASETS.values()]
+    return aggregate_years(stack_years(frames, list(DATASETS)), n=TOP_FACILITIES)
+
+
+def test_streaming_matches_whole_file(whole_file_tables):
+    streamed = [stream_year(file, year, CHUNK_ROWS, n=TOP_FACILITIES) for year, file in DATASETS.items()]
+    state_facilities = combine_frames(compact_frame(tables[0]) for tables in streamed)
+    cells = combine_frames(compact_frame(tables[2]) for tables in streamed)
+    assert_tables_equal(whole_file_tables[0], state_facilities)
+    assert_cubes_equal(build_cube(whole_file_tables[2]), build_cube(cells))
+
+
+def test_incremental_load_matches_full_recompute(tmp_path, monkeypatch):
+    datasets_dir = tmp_path / 'datasets'
+    datasets_dir.mkdir()
+    for file in DATASETS.values():
+        shutil.copy(file, datasets_dir)
+    for module in (cache, ingest):
+        monkeypatch.setattr(module, 'CACHE_DIR', str(tmp_path / 'cache'))
+        monkeypatch.setattr(module, 'USE_CACHE', True)
+    monkeypatch.setattr(ingest, 'STREAM_CHUNK_ROWS', 0)
+    datasets = ingest.discover_datasets(str(datasets_dir))
+    files, years = list(datasets.values()), list(datasets)
+    ingest.load_years(files, years)
+
+    # change the last year by dropping its first facility (the row after the three title rows and the header)
+    changed_file = files[-1]
+    with open(changed_file, 'rb') as source:
+        lines = source.read().split(b'\n')
+    del lines[4]
+    with open(changed_file, 'wb') as output:
+        output.write(b'\n'.join(lines))
+
+    processed = []
+    process_years = ingest.process_years
+    monkeypatch.setattr(ingest, 'process_years', lambda files, years, **kwargs: processed.append(years) or process_years(files, years, **kwargs))
+    incremental = ingest.load_years(files, years)
+    assert processed == [years[-1:]]
+
+    monkeypatch.setattr(cache, 'USE_CACHE', False)
+    full = process_years(files, years)
+    for expected, actual in zip(full[:2], incremental[:2]):
+        assert_tables_equal(expected, actual)
+    # the order of the cells depends on how the years were grouped, so they are compared through the sorted rollups
+    assert_cubes_equal(build_cube(full[2]), build_cube(incremental[2]))
+
+
+def test_spatial_queries_match_brute_force(whole_file_tables):
+    locations = whole_file_tables[1]
+    index = spatial.build_spatial_index(locations)
+    latitudes, longitudes = locations['Latitude'].to_numpy(), locations['Longitude'].to_numpy()
+    rng = np.random.default_rng(0)
+    for query in range(100):
+        year = [None, *DATASETS][query % 3]
+        power_plants_only = query % 2 == 0
+        kept = np.ones(len(locations), dtype=bool)
+        if year is not None:
+            kept &= locations['Year'].to_numpy() == year
+        if power_plants_only:
+            kept &= locations['Power Plant'].to_numpy(dtype=bool)
+        # a point near a random facility, so most queries find some
+        center = rng.integers(len(locations))
+        latitude, longitude = latitudes[center] + rng.normal(0, 1), longitudes[center] + rng.normal(0, 1)
+
+        south, north = latitude - rng.uniform(0.1, 5), latitude + rng.uniform(0.1, 5)
+        west, east = longitude - rng.uniform(0.1, 8), longitude + rng.uniform(0.1, 8)
+        found = spatial.query_bbox(index, south, west, north, east, year, power_plants_only)
+        inside = kept & (latitudes >= south) & (latitudes <= north) & (longitudes >= west) & (longitudes <= east)
+        assert sorted(found.index) == sorted(locations.index[inside])
+
+        distances = spatial.haversine_km(latitude, longitude, latitudes, longitudes)
+        radius_km = rng.uniform(1, 500)
+        found = spatial.query_radius(index, latitude, longitude, radius_km, year, power_plants_only)
+        inside = kept & (distances <= radius_km)
+        assert sorted(found.index) == sorted(locations.index[inside])
+        np.testing.assert_allclose(found[spatial.DISTANCE], np.sort(distances[inside]))
+
+        k = int(rng.integers(1, 50))
+        found = spatial.query_nearest(index, latitude, longitude, k, year, power_plants_only)
+        np.testing.assert_allclose(found[spatial.DISTANCE], np.sort(distances[kept])[:k])
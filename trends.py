@@ -0,0 +1,111 @@
+import numpy as np
+import pandas as pd
+
+from functions import EMISSIONS
+
+# the columns kept for every facility in the matrix, taken from its latest year
+FACILITY_COLUMNS = ['Facility Id', 'FRS Id', 'Facility Name', 'City', 'State', 'State Name', 'County',
+                    'Industry Type (sectors)', 'Power Plant', 'Power Plant Type']
+
+
+def build_facility_matrix(data):
+    """
+    Build the facility by year matrix of emissions
+
+    Function takes a dataframe from functions.facility_locations (every facility of every year) and
+        Numbers the facilities by their GHGRP Facility Id with pd.factorize (one pass over a hash table),
+        so the same facility gets the same row in every year
+        Numbers the years by their position among the sorted years
+        Scatters the emissions and the row positions of the facilities into two dense arrays in one step each
+    Every facility reports once a year, so every (facility, year) cell is set by at most one row
+    The emissions of facilities that did not report them are the means filled in by fill_na_values
+
+    Returns:
+    A dictionary with:
+        data: the dataframe of facilities, as passed in
+        index: a pd.Index of the facility ids, in the order of the rows of the matrix (index.get_loc finds a facility)
+        years: the sorted years, in the order of the columns of the matrix
+        emissions: a float array of facilities by years, with NaN where a facility did not report that year
+        rows: an integer array of facilities by years with the position of each cell's row in data, -1 where missing
+        facilities: a dataframe of the FACILITY_COLUMNS of every facility, from its latest year, in the order of the matrix
+    """
+    facility_positions, facility_ids = pd.factorize(data['Facility Id'].to_numpy(), sort=True)
+    years = np.unique(data['Year'].to_numpy())
+    year_positions = np.searchsorted(years, data['Year'].to_numpy())
+    emissions = np.full((len(facility_ids), len(years)), np.nan)
+    emissions[facility_positions, year_positions] = data[EMISSIONS].to_numpy(dtype=float)
+    rows = np.full((len(facility_ids), len(years)), -1, dtype=np.int32)
+    rows[facility_positions, year_positions] = np.arange(len(data), dtype=np.int32)
+    # the latest row of every facility is the last one that is set in its row of the matrix
+    # (the matrix is empty when the data has no facilities, as in streaming mode)
+    latest_year = len(years) - 1 - np.argmax(rows[:, ::-1] >= 0, axis=1) if rows.size else np.zeros(0, dtype=np.int64)
+    latest_rows = rows[np.arange(len(facility_ids)), latest_year]
+    facilities = data[FACILITY_COLUMNS].iloc[latest_rows].reset_index(drop=True)
+    return {'data': data, 'index': pd.Index(facility_ids), 'years': years,
+            'emissions': emissions, 'rows': rows, 'facilities': facilities}
+
+
+def facility_trend(matrix, facility_id):
+    """
+    Find the emissions of one facility in every year it reported
+
+    Input is a matrix from build_facility_matrix and a GHGRP Facility Id
+
+    Returns:
+    A dataframe with the Year and CO2 emissions (non-biogenic) of every year the facility reported,
+    empty if the facility is not in the matrix
+    """
+    if facility_id not in matrix['index']:
+        return pd.DataFrame({'Year': pd.Series(dtype=matrix['years'].dtype), EMISSIONS: pd.Series(dtype=float)})
+    emissions = matrix['emissions'][matrix['index'].get_loc(facility_id)]
+    reported = ~np.isnan(emissions)
+    return pd.DataFrame({'Year': matrix['years'][reported], EMISSIONS: emissions[reported]})
+
+
+def year_emissions(matrix, year):
+    """
+    Find the emissions of every facility in one year of a matrix from build_facility_matrix
+
+    Returns:
+    A float array in the order of the rows of the matrix, all NaN if the year is not in the matrix
+    """
+    position = np.searchsorted(matrix['years'], year)
+    if position < len(matrix['years']) and matrix['years'][position] == year:
+        return matrix['emissions'][:, position]
+    return np.full(len(matrix['index']), np.nan)
+
+
+def emission_changes(matrix, start_year, end_year, k=10, increasers=False, state=None, power_plants_only=True):
+    """
+    Find the facilities whose emissions fell (or rose) the most from one year to another
+
+    Input is a matrix from build_facility_matrix, the two years, the number of facilities to find,
+    whether to find the largest increases instead of the largest decreases, a state name (None for every state)
+    and whether to only rank power plants
+
+    The change of every facility is one subtraction of two columns of the matrix and the ranking one argsort,
+    so no frames are merged; facilities that did not report in both years have no change and are left out,
+    so a year without a dataset gives no facilities
+
+    Returns:
+    A dataframe of the k facilities with the largest changes, largest first, with their FACILITY_COLUMNS,
+    the emissions of both years (Start Emissions and End Emissions), the Change and the Percent Change
+    """
+    start = year_emissions(matrix, start_year)
+    end = year_emissions(matrix, end_year)
+    change = end - start
+    selected = ~np.isnan(change)
+    facilities = matrix['facilities']
+    if state is not None:
+        selected &= (facilities['State Name'] == state).to_numpy()
+    if power_plants_only:
+        selected &= facilities['Power Plant'].to_numpy(dtype=bool)
+    positions = np.flatnonzero(selected)
+    # a stable sort, so facilities with equal changes stay in order of their id
+    order = np.argsort(-change[positions] if increasers else change[positions], kind='stable')[:k]
+    positions = positions[order]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        percent_change = np.where(start[positions] != 0, 100 * change[positions] / start[positions], np.nan)
+    return facilities.iloc[positions].assign(**{
+        'Start Emissions': start[positions], 'End Emissions': end[positions],
+        'Change': change[positions], 'Percent Change': percent_change}).reset_index(drop=True)